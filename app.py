@@ -1,9 +1,12 @@
 import sys
+import multiprocessing
 from PyQt6.QtWidgets import QApplication
 from ui.styles import DARK_STYLESHEET
 from ui.main_window import MainWindow
 
 if __name__ == "__main__":
+    # Necesario para el pool de procesos de la ingesta en ejecutables congelados (PyInstaller)
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setStyleSheet(DARK_STYLESHEET)
     window = MainWindow()
@@ -12,12 +12,30 @@ MAX_SUMMARY_CHARS_FOR_GEN = 70000
 TOKENS_PER_BLOCK_MIN = 1000
 TOKENS_PER_BLOCK_MAX = 1400
 
+# Agregación jerárquica de resúmenes de bloque (fusiones en árbol)
+AGGREGATE_GROUP_TOKENS = 12000   # entrada máxima estimada de cada fusión
+AGGREGATE_OUTPUT_TOKENS = 1200   # salida estimada de cada fusión
+
 # Selección de imágenes (ingesta)
 MAX_IMGS_PER_BLOCK = 2
 MAX_IMGS_PER_PAGE = 2
 IMAGE_TOKEN_EQUIV = 400
 MIN_IMAGE_AREA = 40000
 DEDUPLICATE_IMAGES = True
+IMAGE_MAX_SIDE = 1600        # px; las imágenes mayores se reescalan
+IMAGE_JPEG_QUALITY = 85
+TRANSCODE_WORKERS = 4        # hilos para decodificar/reescalar/codificar imágenes
+TRANSCODE_CACHE_ENABLED = True
+TRANSCODE_CACHE_MAX_MB = 512
+
+# Deduplicación perceptual (dHash) de imágenes casi idénticas
+PERCEPTUAL_DEDUP = False
+PERCEPTUAL_MAX_DISTANCE = 6      # bits distintos (de 64) para considerarlas iguales
+# Las páginas de texto con el mismo diseño dan dHashes casi iguales: no se descartan
+# imágenes con texto aparente (ver OCR_TEXT_MIN_CELLS)
+PERCEPTUAL_KEEP_TEXT = True
+PERCEPTUAL_PERSIST = False       # recordar imágenes vistas entre ejecuciones
+PERCEPTUAL_INDEX_MAX = 20000
 
 # OCR
 OCR_ENABLED = True
@@ -25,16 +43,59 @@ OCR_MODE = "auto"          # "auto" | "local" | "llm" | "off"
 OCR_LANG = "spa+eng"       # idioma(s) para Tesseract si está disponible
 OCR_TEXT_MAX_CHARS = 1200
 OCR_TOKEN_ESTIMATE = 600
+OCR_WORKERS = 4            # procesos para tesseract, compartidos por todos los archivos
+                           # (1 = en serie, sin pool de procesos; se limita al número de núcleos)
+OCR_LLM_CONCURRENCY = 4    # peticiones de OCR vía LLM en paralelo
+OCR_LLM_MODEL = "gpt-4.1-mini"
+OCR_CACHE_ENABLED = True   # textos OCR en disco por hash de imagen, motor e idioma/modelo
+OCR_CACHE_MAX_MB = 64
+OCR_TEXT_DETECTION = True  # saltar el OCR en imágenes sin texto aparente (fotos, gráficos)
+OCR_TEXT_MIN_CELLS = 8     # celdas de 16 px con aspecto de texto para considerar que lo hay
 
 # Segmentación semántica
 SEMANTIC_SPLIT_ENABLED = True
 SEMANTIC_SIM_THRESHOLD = 0.82
 SEMANTIC_MIN_TOKENS = 400
-SEMANTIC_TARGET_TOKENS = 1000
-SEMANTIC_MAX_SENTENCES = 1800
+SEMANTIC_TARGET_TOKENS = TOKENS_PER_BLOCK_MAX   # máximo por trozo: cada trozo llena un bloque
+SEMANTIC_TILING_WINDOW = 3          # oraciones a cada lado al comparar una frontera
+SEMANTIC_WINDOW_SENTENCES = 512     # oraciones embebidas por ventana (sin límite de longitud total)
+EMBEDDINGS_BACKEND = "openai"        # "openai" (remoto) | "local" (TF-IDF con hashing, sin red)
+LOCAL_EMBEDDINGS_DIM = 1024
+LOCAL_EMBEDDINGS_SIM_THRESHOLD = 0.03
+EMBEDDINGS_CACHE_ENABLED = True      # embeddings de oraciones en disco, por modelo + hash
+EMBEDDINGS_CACHE_MAX_MB = 256
+EMBEDDINGS_CACHE_DTYPE = "float16"   # "float16" (mitad de espacio) o "float32"
+EMBEDDINGS_BATCH_MAX_ITEMS = 256     # oraciones por petición de embeddings
+EMBEDDINGS_BATCH_MAX_TOKENS = 8000   # tokens estimados por petición
+EMBEDDINGS_CONCURRENCY = 2           # peticiones de embeddings en paralelo por texto
 
 # Presupuesto por minuto
 TPM_BUDGET = 80000
 RPM_BUDGET = 60
-CONCURRENCY = 1
-COOLDOWN_MS = 800
+CONCURRENCY = 4            # bloques resumidos a la vez (en total, entre archivos)
+FILE_CONCURRENCY = 3       # archivos analizados a la vez (comparten el presupuesto)
+
+# Reintentos ante 429/5xx y cortocircuito ante caídas sostenidas
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY_S = 1.0
+RETRY_MAX_DELAY_S = 60.0
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_S = 60
+
+# Checkpoints por bloque (reanudar análisis interrumpidos)
+CHECKPOINTS_ENABLED = True
+CHECKPOINT_MAX_AGE_DAYS = 30
+
+# Caché de respuestas del LLM (resúmenes de bloque y OCR), por modelo + prompt + contenido
+LLM_CACHE_MODE = "use"     # "use" | "refresh" (ignora lo guardado y lo reescribe) | "off"
+LLM_CACHE_MAX_MB = 256
+LLM_CACHE_TTL_DAYS = 30
+
+# Ingesta paralela de PDF (pool de procesos por rangos de páginas)
+INGEST_WORKERS = 4              # 1 = secuencial; se limita al número de núcleos
+INGEST_PAGES_PER_CHUNK = 25
+INGEST_PARALLEL_MIN_PAGES = 60  # por debajo de esto no compensa lanzar el pool
+
+# Caché de ingesta en disco (por hash de contenido del documento)
+INGEST_CACHE_ENABLED = True
+INGEST_CACHE_MAX_MB = 1024
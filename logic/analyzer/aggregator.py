@@ -0,0 +1,89 @@
+# logic/analyzer/aggregator.py
+from __future__ import annotations
+from concurrent.futures import Executor, Future
+from typing import Callable, List, Union
+
+from config import AGGREGATE_GROUP_TOKENS, AGGREGATE_OUTPUT_TOKENS
+
+# Un nodo del árbol es un resumen ya disponible o la fusión que lo producirá
+_Node = Union[str, Future]
+
+
+def _cost(node: _Node) -> int:
+    # Las fusiones pendientes cuentan como su salida estimada
+    if isinstance(node, Future):
+        if not node.done() or node.exception() is not None:
+            return AGGREGATE_OUTPUT_TOKENS
+        node = node.result()
+    return max(1, len(node) // 4)
+
+
+def _resolve(node: _Node) -> str:
+    return node.result() if isinstance(node, Future) else node
+
+
+class TreeReducer:
+    """
+    Agregación jerárquica (map-reduce en árbol) de resúmenes de bloque.
+    Los resúmenes se añaden en orden con `add`; en cuanto un grupo alcanza `group_tokens`
+    se envía su fusión al pool (sin esperar al resto del documento) y el resultado sube
+    al nivel siguiente, que se agrupa igual. `result` cierra los grupos pendientes y
+    repite por niveles hasta que queda un único resumen.
+    `merge` recibe una lista de textos (en orden) y devuelve su fusión; se ejecuta en `pool`,
+    así que las fusiones de un mismo nivel corren en paralelo (el limitador reparte el presupuesto).
+    """
+    def __init__(self, merge: Callable[[List[str]], str], pool: Executor,
+                 group_tokens: int = AGGREGATE_GROUP_TOKENS):
+        self.merge = merge
+        self.pool = pool
+        self.group_tokens = max(1, group_tokens)
+        self.merges = 0
+        # Por nivel: grupo abierto y su coste estimado
+        self._groups: List[List[_Node]] = []
+        self._costs: List[int] = []
+
+    def add(self, summary: str) -> None:
+        if summary and summary.strip():
+            self._push(0, summary.strip())
+
+    def _push(self, level: int, node: _Node) -> None:
+        if level == len(self._groups):
+            self._groups.append([])
+            self._costs.append(0)
+        cost = _cost(node)
+        group = self._groups[level]
+        # El grupo se cierra cuando el siguiente nodo lo haría pasar del presupuesto
+        if len(group) >= 2 and self._costs[level] + cost > self.group_tokens:
+            self._close(level)
+            group = self._groups[level]
+        group.append(node)
+        self._costs[level] += cost
+
+    def _close(self, level: int) -> None:
+        group = self._groups[level]
+        self._groups[level] = []
+        self._costs[level] = 0
+        if len(group) == 1:
+            self._push(level + 1, group[0])
+        elif group:
+            self._push(level + 1, self._submit(group))
+
+    def _submit(self, group: List[_Node]) -> Future:
+        self.merges += 1
+        # Los hijos se enviaron antes que el padre (cola FIFO): esperar por ellos no bloquea el pool
+        return self.pool.submit(lambda: self.merge([_resolve(n) for n in group]))
+
+    def result(self) -> str:
+        """Cierra los grupos abiertos nivel a nivel y devuelve el resumen raíz."""
+        level = 0
+        while level < len(self._groups):
+            is_top = level == len(self._groups) - 1
+            if is_top and len(self._groups[level]) <= 1:
+                group = self._groups[level]
+                return _resolve(group[0]) if group else ""
+            if is_top and self._costs[level] <= self.group_tokens:
+                # Cabe en una sola fusión: es la raíz
+                return _resolve(self._submit(self._groups[level]))
+            self._close(level)
+            level += 1
+        return ""
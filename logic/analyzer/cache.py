@@ -0,0 +1,194 @@
+# logic/analyzer/cache.py
+from __future__ import annotations
+import os
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from utils.paths import CACHE_DIR
+
+
+class DiskCache:
+    """
+    Caché clave→bytes persistida en SQLite, acotada por tamaño con expulsión LRU
+    y, opcionalmente, por antigüedad (`ttl_s`: las entradas más viejas cuentan como fallo).
+    Es segura para varios hilos del mismo proceso. Lleva contadores de aciertos,
+    fallos y expulsiones para poder monitorizarla (`stats`).
+    """
+    def __init__(self, path: str, max_bytes: int, ttl_s: Optional[float] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # timeout: varios procesos (pool de ingesta) pueden compartir el mismo archivo
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed)")
+        self._db.commit()
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT value, size, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            if self.ttl_s is not None and now - row[2] > self.ttl_s:
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._db.commit()
+                self._bytes -= row[1]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        """Como `get` para muchas claves en una sola transacción; devuelve solo las encontradas."""
+        found: Dict[str, bytes] = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            unique = list(dict.fromkeys(keys))
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._db.execute(
+                    f"SELECT key, value, created FROM entries WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, value, created in rows:
+                    if self.ttl_s is not None and now - created > self.ttl_s:
+                        continue
+                    found[key] = value
+            if found:
+                self._db.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(now, k) for k in found])
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(unique) - len(found)
+        return found
+
+    def set_many(self, entries: Dict[str, bytes]) -> None:
+        """Como `set` para muchas entradas en una sola transacción."""
+        now = time.time()
+        with self._lock:
+            for key, value in entries.items():
+                size = len(value)
+                if size > self.max_bytes:
+                    continue
+                old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, sqlite3.Binary(value), size, now, now)
+                )
+                self._bytes += size - (old[0] if old else 0)
+            self._evict_locked()
+            self._db.commit()
+
+    def contains(self, key: str) -> bool:
+        """Comprueba si existe la clave sin tocar contadores ni el orden LRU."""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def set(self, key: str, value: bytes) -> None:
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), size, now, now)
+            )
+            self._bytes += size - (old[0] if old else 0)
+            self._evict_locked()
+            self._db.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            row = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._db.commit()
+            self._bytes -= row[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+            self._bytes = 0
+
+    def purge_expired(self) -> int:
+        """Borra de una vez todas las entradas caducadas por TTL. Devuelve cuántas."""
+        if self.ttl_s is None:
+            return 0
+        with self._lock:
+            cur = self._db.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl_s,))
+            self._db.commit()
+            removed = max(0, cur.rowcount)
+            self.expired += removed
+            self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            return removed
+
+    def _evict_locked(self) -> None:
+        # Expulsa las entradas menos usadas recientemente hasta volver bajo el límite.
+        # El contador local puede desviarse si otro proceso escribe: se recalcula antes.
+        if self._bytes > self.max_bytes:
+            self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while self._bytes > self.max_bytes:
+            rows = self._db.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                self._bytes = 0
+                return
+            for key, size in rows:
+                if self._bytes <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "entries": entries,
+                "bytes": self._bytes,
+            }
+
+
+_caches: Dict[str, DiskCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name: str, max_mb: int, ttl_s: Optional[float] = None) -> DiskCache:
+    """Devuelve (creándola si hace falta) la caché compartida `name` bajo CACHE_DIR."""
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is None:
+            cache = DiskCache(os.path.join(CACHE_DIR, f"{name}.sqlite"), max_mb * 1024 * 1024, ttl_s)
+            _caches[name] = cache
+        return cache
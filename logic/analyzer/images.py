@@ -0,0 +1,312 @@
+# logic/analyzer/images.py
+from __future__ import annotations
+import os
+import io
+import json
+import base64
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from logic.analyzer.cache import DiskCache, get_cache
+from config import (
+    PERCEPTUAL_MAX_DISTANCE, PERCEPTUAL_INDEX_MAX, PERCEPTUAL_KEEP_TEXT, OCR_TEXT_MIN_CELLS,
+    IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, TRANSCODE_WORKERS,
+    TRANSCODE_CACHE_ENABLED, TRANSCODE_CACHE_MAX_MB
+)
+
+# Subir si cambia `transcode` o el formato de ImageRef, para invalidar la caché
+_TRANSCODE_CACHE_VERSION = 1
+
+
+@dataclass
+class ImageRef:
+    """
+    Imagen ya transcodificada que viaja dentro de los items de ingesta.
+    Guarda los bytes crudos (JPEG/PNG) y se codifica a base64 solo al construir
+    el mensaje para el modelo (`to_data_url`). `phash` es su dHash de 64 bits.
+    """
+    data: bytes = field(repr=False)
+    media_type: str
+    width: int
+    height: int
+    phash: int = 0
+
+    @property
+    def area(self) -> int:
+        return self.width * self.height
+
+    def to_data_url(self) -> str:
+        return f"data:{self.media_type};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+
+def dhash(im: Image.Image) -> int:
+    """
+    Hash perceptual por diferencias (dHash) de 64 bits: compara cada píxel con su vecino
+    derecho en una miniatura 9x8 en gris. Es estable ante cambios de resolución y recompresión.
+    """
+    small = im.convert("L").resize((9, 8), Image.BILINEAR)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (1 if px[row * 9 + col] > px[row * 9 + col + 1] else 0)
+    return bits
+
+
+def transcode(img_bytes: bytes, prefer_format: str | None = None) -> ImageRef:
+    """
+    Normaliza una imagen a JPEG (o PNG si se prefiere), reescalando si el mayor lado supera
+    IMAGE_MAX_SIDE px. Camino rápido:
+      - Si ya cabe y está en el formato/modo de salida, se reutilizan los bytes sin recodificar.
+      - Los JPEG grandes se decodifican en modo draft (escalado DCT 1/2, 1/4, 1/8).
+      - `Image.reduce` baja por un factor entero antes del filtro LANCZOS final.
+    """
+    out_fmt = "PNG" if (prefer_format or "").lower() == "png" else "JPEG"
+    media = "image/png" if out_fmt == "PNG" else "image/jpeg"
+    with Image.open(io.BytesIO(img_bytes)) as im:
+        w, h = im.size
+        scale = min(1.0, float(IMAGE_MAX_SIDE) / max(w, h))
+        tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+
+        if scale == 1.0 and im.format == out_fmt and im.mode in ("RGB", "L"):
+            if im.format == "JPEG":
+                im.draft("L", (64, 64))  # basta una miniatura para el dHash
+            return ImageRef(data=img_bytes, media_type=media, width=w, height=h, phash=dhash(im))
+
+        if im.format == "JPEG" and scale < 1.0:
+            im.draft("RGB", (tw, th))
+        im = im.convert("RGB")
+        if im.size != (tw, th):
+            # Se deja al menos 2x de margen para que LANCZOS conserve la calidad
+            factor = min(im.size[0] // tw, im.size[1] // th) // 2
+            if factor >= 2:
+                im = im.reduce(factor)
+            im = im.resize((tw, th), Image.LANCZOS)
+
+        buf = io.BytesIO()
+        if out_fmt == "JPEG":
+            im.save(buf, format="JPEG", optimize=True, quality=IMAGE_JPEG_QUALITY)
+        else:
+            im.save(buf, format="PNG", compress_level=6)
+        return ImageRef(data=buf.getvalue(), media_type=media, width=tw, height=th, phash=dhash(im))
+
+
+def transcode_cache() -> DiskCache:
+    """Caché persistente de imágenes ya transcodificadas (expone `stats()` con la tasa de aciertos)."""
+    return get_cache("transcode", TRANSCODE_CACHE_MAX_MB)
+
+
+def transcode_cached(img_bytes: bytes, prefer_format: str | None, src_hash: str) -> ImageRef:
+    """
+    Igual que `transcode`, pero consulta primero la caché entre ejecuciones, indexada por
+    el hash de los bytes de origen y los parámetros de transcodificación.
+    """
+    if not TRANSCODE_CACHE_ENABLED:
+        return transcode(img_bytes, prefer_format)
+    cache = transcode_cache()
+    key = f"{src_hash}:{(prefer_format or '').lower()}:{IMAGE_MAX_SIDE}:{IMAGE_JPEG_QUALITY}:{_TRANSCODE_CACHE_VERSION}"
+    blob = cache.get(key)
+    if blob is not None:
+        return pickle.loads(blob)
+    ref = transcode(img_bytes, prefer_format)
+    cache.set(key, pickle.dumps(ref, protocol=pickle.HIGHEST_PROTOCOL))
+    return ref
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def transcode_pool() -> ThreadPoolExecutor:
+    """Pool de hilos compartido para transcodificar (Pillow libera el GIL al decodificar/codificar)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+        return _pool
+
+
+# Celdas de 16x16 px sobre la imagen reducida; una celda "de texto" tiene mucho borde nítido
+# y casi todos sus píxeles en dos tonos (tinta y fondo), a diferencia de la textura de una foto
+_TEXT_CELL = 16
+_TEXT_SIDE = 512
+
+
+def count_text_cells(img_bytes: bytes) -> int:
+    """
+    Detector barato de presencia de texto: número de celdas con aspecto de texto
+    (densidad de bordes alta, contraste alto y pocos tonos intermedios) en una versión
+    en grises de como mucho _TEXT_SIDE px. 0 si no se puede decodificar.
+    """
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:
+            im.draft("L", (_TEXT_SIDE, _TEXT_SIDE))
+            g = im.convert("L")
+            g.thumbnail((_TEXT_SIDE, _TEXT_SIDE))
+            a = np.asarray(g, dtype=np.int16)
+    except Exception:
+        return 0
+
+    h = (a.shape[0] // _TEXT_CELL) * _TEXT_CELL
+    w = (a.shape[1] // _TEXT_CELL) * _TEXT_CELL
+    if h == 0 or w == 0:
+        return 0
+    a = a[:h, :w]
+
+    # Bordes nítidos horizontales y verticales
+    edges = np.zeros(a.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(a, axis=1)) > 48
+    edges[1:, :] |= np.abs(np.diff(a, axis=0)) > 48
+
+    def cells(x: np.ndarray) -> np.ndarray:
+        return x.reshape(h // _TEXT_CELL, _TEXT_CELL, w // _TEXT_CELL, _TEXT_CELL).swapaxes(1, 2).reshape(-1, _TEXT_CELL * _TEXT_CELL)
+
+    px = cells(a)
+    lo = np.percentile(px, 5, axis=1, keepdims=True)
+    hi = np.percentile(px, 95, axis=1, keepdims=True)
+    span = hi - lo
+    mid = ((px > lo + span / 4) & (px < hi - span / 4)).mean(axis=1)
+    e = cells(edges).reshape(-1, _TEXT_CELL, _TEXT_CELL)
+    density = e.mean(axis=(1, 2))
+    # Los trazos de letra ocupan muchas filas y columnas de la celda; una línea o el borde
+    # de una barra de un gráfico solo una o dos
+    rows = e.any(axis=2).mean(axis=1)
+    cols = e.any(axis=1).mean(axis=1)
+
+    text_cells = (density > 0.08) & (span[:, 0] > 80) & (mid < 0.3) & (rows >= 0.5) & (cols >= 0.5)
+    return int(text_cells.sum())
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PerceptualIndex:
+    """
+    Índice de dHashes ya vistos, agrupados por documento (hash de contenido). Una imagen
+    es casi-duplicada si dista como mucho `max_distance` bits de alguna de un documento
+    anterior; las repetidas dentro del propio documento las resuelve `iter_drop_near_duplicates`.
+    Es seguro compartirlo entre hilos y puede persistirse entre ejecuciones (`load`/`save`).
+    Los documentos de la ejecución actual se declaran en orden con `begin`: uno solo se
+    compara con los anteriores en esa lista y con los persistidos. Para que el resultado
+    no dependa de qué archivo avance antes, las imágenes de los anteriores se registran
+    antes de empezar (`record`, ver `prescan`).
+    """
+    def __init__(self, max_distance: int = PERCEPTUAL_MAX_DISTANCE, path: Optional[str] = None):
+        self.max_distance = max_distance
+        self.path = path
+        self._hashes: Dict[str, List[int]] = {}
+        # Orden de los documentos de esta ejecución; los persistidos de otras cuentan como anteriores
+        self._order: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, docs: List[str]) -> List[str]:
+        """
+        Declara los documentos de esta ejecución en orden; re-analizar uno sustituye sus
+        hashes guardados. Devuelve la clave de cada uno para `is_duplicate`/`record`
+        (un documento repetido en la lista recibe una clave propia, que no se persiste).
+        """
+        keys: List[str] = []
+        with self._lock:
+            for doc in docs:
+                key = doc if doc not in self._order else f"{doc}#{len(self._order)}"
+                self._order[key] = len(self._order)
+                self._hashes.pop(key, None)
+                keys.append(key)
+        return keys
+
+    def is_duplicate(self, h: int, doc: str = "") -> bool:
+        """True si `h` es casi-duplicado de alguna imagen de un documento anterior a `doc`."""
+        with self._lock:
+            rank = self._order.get(doc, -1)
+            for other, hashes in self._hashes.items():
+                # Solo cuentan los persistidos y los anteriores en esta ejecución
+                if other == doc or (other in self._order and self._order[other] >= rank):
+                    continue
+                if any(hamming(seen, h) <= self.max_distance for seen in hashes):
+                    return True
+            return False
+
+    def record(self, doc: str, hashes: List[int]) -> None:
+        """Registra las imágenes conservadas de `doc` (sustituye las anteriores)."""
+        with self._lock:
+            self._hashes[doc] = list(hashes)
+
+    def load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                hashes = {str(doc): [int(h) for h in hs] for doc, hs in data.items()}
+                with self._lock:
+                    for doc, hs in hashes.items():
+                        if doc not in self._order:
+                            self._hashes[doc] = hs
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, TypeError):
+            pass
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            # Se descartan los documentos más antiguos por encima de PERCEPTUAL_INDEX_MAX hashes
+            data: Dict[str, List[int]] = {}
+            total = 0
+            for doc, hashes in reversed(list(self._hashes.items())):
+                if "#" in doc:
+                    continue
+                if total + len(hashes) > PERCEPTUAL_INDEX_MAX:
+                    break
+                data[doc] = list(hashes)
+                total += len(hashes)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(dict(reversed(list(data.items()))), f)
+
+
+def _keep_as_text(ref: ImageRef) -> bool:
+    # Solo se evalúa ante una coincidencia, así que el coste recae en pocas imágenes
+    return PERCEPTUAL_KEEP_TEXT and count_text_cells(ref.data) >= OCR_TEXT_MIN_CELLS
+
+
+def iter_drop_near_duplicates(items: Iterable[Dict[str, Any]], index: PerceptualIndex, doc: str = "") -> Iterator[Dict[str, Any]]:
+    """
+    Descarta imágenes casi idénticas a otras anteriores del mismo documento o de los
+    documentos previos del índice (misma figura a otra resolución, fondos de diapositiva
+    repetidos...). Los items de texto pasan intactos. Al agotarse el flujo, las imágenes
+    conservadas quedan registradas en el índice para `doc`.
+    Con PERCEPTUAL_KEEP_TEXT, una coincidencia solo se descarta si la imagen no tiene
+    texto aparente: 64 bits no distinguen dos páginas escaneadas con el mismo diseño.
+    """
+    kept: List[int] = []
+    for it in items:
+        if it.get("kind") == "image":
+            ref: Optional[ImageRef] = it.get("image")
+            if ref is not None:
+                h = ref.phash
+                seen = any(hamming(k, h) <= index.max_distance for k in kept) or index.is_duplicate(h, doc)
+                if seen and not _keep_as_text(ref):
+                    continue
+                if not seen:
+                    kept.append(h)
+        yield it
+    index.record(doc, kept)
+
+
+def prescan(docs: List[Tuple[str, Iterable[Dict[str, Any]]]], index: PerceptualIndex) -> None:
+    """
+    Pasada previa en orden sobre (clave, items) de cada documento: registra en el índice
+    las imágenes que conservará cada uno, de modo que luego los documentos pueden
+    deduplicarse en paralelo contra los anteriores sin esperarse entre sí.
+    """
+    for doc, items in docs:
+        for _ in iter_drop_near_duplicates((it for it in items if it.get("kind") == "image"), index, doc):
+            pass
@@ -2,119 +2,376 @@
 from __future__ import annotations
 import os
 import io
-import base64
 import hashlib
-from typing import List, Dict, Any, Tuple
+import pickle
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import List, Dict, Any, Tuple, Iterator, Deque, Optional
 
 import fitz  # PyMuPDF
 from docx import Document as DocxDocument
 from pptx import Presentation
 from PIL import Image
 
-from config import MAX_IMGS_PER_PAGE, MIN_IMAGE_AREA, DEDUPLICATE_IMAGES
+from logic.analyzer.images import ImageRef, transcode_cached, transcode_pool
+from logic.analyzer.cache import DiskCache, get_cache
+from config import (
+    MAX_IMGS_PER_PAGE, MIN_IMAGE_AREA, DEDUPLICATE_IMAGES,
+    IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, TRANSCODE_WORKERS,
+    INGEST_WORKERS, INGEST_PAGES_PER_CHUNK, INGEST_PARALLEL_MIN_PAGES,
+    INGEST_CACHE_ENABLED, INGEST_CACHE_MAX_MB
+)
 
+# Subir si cambia el formato de los items, para invalidar la caché de ingesta
+_INGEST_CACHE_VERSION = 5
+_CACHE_CHUNK_BYTES = 4 * 1024 * 1024
 
-def _b64_data_url(img_bytes: bytes, prefer_format: str | None = None) -> Tuple[str, int, int, int]:
+
+def _pending_image(raw: bytes, ext: str, page: int, hsh: str) -> Dict[str, Any]:
+    # Imagen seleccionada pero aún sin transcodificar; la resuelve `_transcode_stream`
+    return {"kind": "image", "page": page, "hash": hsh, "_raw": raw, "_ext": ext}
+
+
+def _image_item(ref: ImageRef, page: int, hsh: str) -> Dict[str, Any]:
+    return {
+        "kind": "image",
+        "image": ref,
+        "page": page,
+        "width": ref.width,
+        "height": ref.height,
+        "area": ref.area,
+        "caption": None,
+        "hash": hsh
+    }
+
+
+def _transcode_stream(items: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     """
-    Convierte una imagen a data URL base64, reescala si el mayor lado >1600 px.
-    Devuelve (data_url, width, height, area).
+    Transcodifica en el pool de hilos las imágenes pendientes, manteniendo el orden de
+    los items y como mucho 2*TRANSCODE_WORKERS imágenes en vuelo.
     """
-    with Image.open(io.BytesIO(img_bytes)) as im:
-        im = im.convert("RGB")
-        w, h = im.size
-        max_side = max(w, h)
-        if max_side > 1600:
-            scale = 1600.0 / max_side
-            im = im.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-        buf = io.BytesIO()
-        out_fmt = "JPEG"
-        if prefer_format:
-            pf = prefer_format.lower()
-            if pf == "png":
-                out_fmt = "PNG"
-        im.save(buf, format=out_fmt, optimize=True, quality=85)
-        data = base64.b64encode(buf.getvalue()).decode("utf-8")
-        media = "image/png" if out_fmt == "PNG" else "image/jpeg"
-        w2, h2 = im.size
-        return f"data:{media};base64,{data}", w2, h2, (w2 * h2)
+    pool = transcode_pool()
+    window = 2 * TRANSCODE_WORKERS
+    pending: Deque[Tuple[Dict[str, Any], Optional[Future]]] = deque()
+
+    def _emit(it: Dict[str, Any], fut: Optional[Future]) -> Optional[Dict[str, Any]]:
+        if fut is None:
+            return it
+        try:
+            return _image_item(fut.result(), it["page"], it["hash"])
+        except Exception:
+            return None
+
+    try:
+        for it in items:
+            fut = None
+            if "_raw" in it:
+                fut = pool.submit(transcode_cached, it["_raw"], it["_ext"], it["hash"])
+            pending.append((it, fut))
+            while len(pending) > window or (pending and pending[0][1] is None):
+                out = _emit(*pending.popleft())
+                if out is not None:
+                    yield out
+        while pending:
+            out = _emit(*pending.popleft())
+            if out is not None:
+                yield out
+    finally:
+        for _, fut in pending:
+            if fut is not None:
+                fut.cancel()
 
 
 def _hash_bytes(data: bytes) -> str:
     return hashlib.md5(data).hexdigest()
 
 
-def ingest_files(paths: List[str]) -> List[Dict[str, Any]]:
+def ingest_files(paths: List[str], workers: int = INGEST_WORKERS) -> List[Dict[str, Any]]:
     """
     Ingesta unificada para PDF, DOCX y PPTX. Devuelve items:
       - {"kind":"text","text":..., "page":N}
-      - {"kind":"image","data_url":..., "page":N, "width":W, "height":H, "area":A, "caption": None}
+      - {"kind":"image","image":ImageRef, "page":N, "width":W, "height":H, "area":A, "caption": None, "hash": H}
     No aplica OCR aquí (se hace después para mantener esta fase libre de API externas).
+    Con workers > 1, los PDFs grandes se procesan por rangos de páginas en un pool de procesos.
+    """
+    return list(iter_items(paths, workers=workers))
+
+
+def iter_items(paths: List[str], workers: int = INGEST_WORKERS, use_cache: bool = INGEST_CACHE_ENABLED) -> Iterator[Dict[str, Any]]:
+    """
+    Versión en streaming de `ingest_files`: produce los items en orden a medida que se
+    extraen, sin materializar el documento completo en memoria.
+    Cada archivo se ingiere por separado (y se cachea por hash de contenido); las imágenes
+    repetidas entre archivos se descartan aquí.
     """
-    items: List[Dict[str, Any]] = []
     seen_hashes: set[str] = set()
 
     for path in paths:
         ext = os.path.splitext(path)[1].lower()
-        if ext == ".pdf":
-            items.extend(_ingest_pdf(path, seen_hashes))
-        elif ext == ".docx":
-            items.extend(_ingest_docx(path, seen_hashes))
-        elif ext == ".pptx":
-            items.extend(_ingest_pptx(path, seen_hashes))
-        else:
+        if ext not in (".pdf", ".docx", ".pptx"):
             continue
-    return items
+        source = _iter_cached_file(path, workers) if use_cache else _iter_file(path, workers)
+        for it in source:
+            if DEDUPLICATE_IMAGES and it["kind"] == "image":
+                if it["hash"] in seen_hashes:
+                    continue
+                seen_hashes.add(it["hash"])
+            yield it
+
+
+def _iter_file(path: str, workers: int) -> Iterator[Dict[str, Any]]:
+    ext = os.path.splitext(path)[1].lower()
+    seen_hashes: set[str] = set()
+    if ext == ".pdf":
+        source = _ingest_pdf(path, seen_hashes, workers=workers)
+    elif ext == ".docx":
+        source = _ingest_docx(path, seen_hashes)
+    elif ext == ".pptx":
+        source = _ingest_pptx(path, seen_hashes)
+    else:
+        return
+    yield from _transcode_stream(source)
+
+
+def ingest_cache() -> DiskCache:
+    """Caché persistente de items ya extraídos (expone `stats()` con aciertos, fallos y bytes)."""
+    return get_cache("ingest", INGEST_CACHE_MAX_MB)
 
 
-def _ingest_pdf(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
+def file_digest(path: str) -> str:
+    """SHA-256 del contenido del archivo (identidad del documento para cachés y checkpoints)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _ingest_cache_key(path: str) -> str:
+    # El contenido del archivo más los parámetros que alteran la salida de la ingesta
+    knobs = (_INGEST_CACHE_VERSION, MAX_IMGS_PER_PAGE, MIN_IMAGE_AREA, DEDUPLICATE_IMAGES,
+             IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY)
+    return f"{file_digest(path)}:{_hash_bytes(repr(knobs).encode('utf-8'))}"
+
+
+def _load_cached_chunk(blob: bytes) -> Iterator[Dict[str, Any]]:
+    buf = io.BytesIO(blob)
+    while True:
+        try:
+            yield pickle.load(buf)
+        except EOFError:
+            return
+
+
+def _iter_cached_file(path: str, workers: int) -> Iterator[Dict[str, Any]]:
+    """
+    Ingiere un archivo a través de la caché. Los items se guardan en trozos de
+    ~_CACHE_CHUNK_BYTES más un manifiesto con el número de trozos, de modo que tanto
+    la lectura como la escritura mantienen el streaming.
+    """
+    cache = ingest_cache()
+    key = _ingest_cache_key(path)
+
+    manifest = cache.get(key)
+    if manifest is not None:
+        chunk_keys = [f"{key}:{i}" for i in range(int(manifest))]
+        if all(cache.contains(k) for k in chunk_keys):
+            emitted = 0
+            for ck in chunk_keys:
+                blob = cache.get(ck)
+                if blob is None:
+                    # Trozo expulsado a mitad de lectura: se re-ingiere y se omite lo ya emitido
+                    yield from islice(_iter_file(path, workers), emitted, None)
+                    return
+                for it in _load_cached_chunk(blob):
+                    emitted += 1
+                    yield it
+            return
+
+    n_chunks = 0
+    buf = io.BytesIO()
+    for it in _iter_file(path, workers):
+        # Se serializa antes de emitir: las etapas siguientes modifican los items in-place
+        pickle.dump(it, buf, protocol=pickle.HIGHEST_PROTOCOL)
+        if buf.tell() >= _CACHE_CHUNK_BYTES:
+            cache.set(f"{key}:{n_chunks}", buf.getvalue())
+            n_chunks += 1
+            buf = io.BytesIO()
+        yield it
+    if buf.tell():
+        cache.set(f"{key}:{n_chunks}", buf.getvalue())
+        n_chunks += 1
+    cache.set(key, str(n_chunks).encode("ascii"))
+
+
+def _pdf_page_items(doc, page, page_idx: int, seen_hashes: set[str], seen_xrefs: set[int]) -> Tuple[List[Dict[str, Any]], List[str], List[int]]:
+    """
+    Extrae texto e imágenes de una página PDF.
+    Devuelve (items, hashes, spares): `hashes` son las imágenes extraídas en la página
+    (para que el llamador pueda deduplicar entre rangos de páginas) y `spares` los xrefs
+    candidatos que quedaron fuera del cupo, de mayor a menor área (ver `_fill_page`).
+    """
     out: List[Dict[str, Any]] = []
+    text = page.get_text("text") or ""
+    if text.strip():
+        out.append({"kind": "text", "text": text, "page": page_idx})
+
+    # Pre-filtro con los metadatos de get_images (xref, smask, width, height, ...):
+    # descarta iconos/logos pequeños y xrefs ya vistos sin extraer ningún byte.
+    candidates: List[Tuple[int, int]] = []  # (area, xref)
+    for img in page.get_images(full=True):
+        xref, w, h = img[0], img[2], img[3]
+        if DEDUPLICATE_IMAGES and xref in seen_xrefs:
+            continue
+        if w * h < MIN_IMAGE_AREA:
+            continue
+        candidates.append((w * h, xref))
+    candidates.sort(key=lambda x: x[0], reverse=True)
+
+    # Solo se extraen (y hashean) las mayores, hasta cubrir el cupo de la página
+    xrefs = [xref for _, xref in candidates]
+    page_imgs, consumed = _take_page_images(doc, xrefs, MAX_IMGS_PER_PAGE, seen_hashes, seen_xrefs)
+    for raw, ext, hsh in page_imgs:
+        out.append(_pending_image(raw, ext, page_idx, hsh))
+    return out, [hsh for _, _, hsh in page_imgs], xrefs[consumed:]
+
+
+def _take_page_images(doc, xrefs: List[int], room: int, seen_hashes: set[str],
+                      seen_xrefs: set[int]) -> Tuple[List[Tuple[bytes, str, str]], int]:
+    """
+    Extrae en orden los xrefs candidatos hasta reunir `room` imágenes no repetidas.
+    Devuelve las imágenes (raw_bytes, ext, hash) y cuántos candidatos se consumieron.
+    """
+    page_imgs: List[Tuple[bytes, str, str]] = []
+    consumed = 0
+    for xref in xrefs:
+        if len(page_imgs) >= room:
+            break
+        consumed += 1
+        if DEDUPLICATE_IMAGES:
+            seen_xrefs.add(xref)
+        try:
+            img_dict = doc.extract_image(xref)
+            img_bytes = img_dict["image"]
+            hsh = _hash_bytes(img_bytes)
+            if DEDUPLICATE_IMAGES and hsh in seen_hashes:
+                continue
+            page_imgs.append((img_bytes, (img_dict.get("ext") or "jpeg").lower(), hsh))
+            if DEDUPLICATE_IMAGES:
+                seen_hashes.add(hsh)
+        except Exception:
+            continue
+    return page_imgs, consumed
+
+
+def _ingest_pdf(path: str, seen_hashes: set[str], workers: int = 1) -> Iterator[Dict[str, Any]]:
+    next_page = 0
+    # Cada proceso hijo tarda ~1 s en importar sus dependencias: sin núcleos libres no compensa
+    workers = min(workers, os.cpu_count() or 1)
+    if workers > 1:
+        with fitz.open(path) as probe:
+            page_count = probe.page_count
+        if page_count >= INGEST_PARALLEL_MIN_PAGES:
+            try:
+                for page_no, page_items in _ingest_pdf_parallel(path, page_count, seen_hashes, workers):
+                    yield from page_items
+                    next_page = page_no + 1
+                return
+            except BrokenProcessPool:
+                # Entorno sin soporte de subprocesos: se continúa en serie desde la última página emitida
+                pass
+
+    seen_xrefs: set[int] = set()
     doc = fitz.open(path)
     try:
-        for page_idx, page in enumerate(doc, start=1):
-            text = page.get_text("text") or ""
-            if text.strip():
-                out.append({"kind": "text", "text": text, "page": page_idx})
+        for page_no in range(next_page, doc.page_count):
+            page_items, _, _ = _pdf_page_items(doc, doc[page_no], page_no + 1, seen_hashes, seen_xrefs)
+            yield from page_items
+    finally:
+        doc.close()
 
-            page_imgs: List[Tuple[int, bytes, str]] = []  # (area, raw_bytes, ext)
-            for img in page.get_images(full=True):
-                try:
-                    xref = img[0]
-                    img_dict = doc.extract_image(xref)
-                    img_bytes = img_dict["image"]
-                    hsh = _hash_bytes(img_bytes)
-                    if DEDUPLICATE_IMAGES and hsh in seen_hashes:
-                        continue
-                    with Image.open(io.BytesIO(img_bytes)) as im:
-                        w, h = im.size
-                        area = w * h
-                    if area < MIN_IMAGE_AREA:
-                        continue
-                    page_imgs.append((area, img_bytes, (img_dict.get("ext") or "jpeg").lower()))
-                    if DEDUPLICATE_IMAGES:
-                        seen_hashes.add(hsh)
-                except Exception:
-                    continue
 
-            if page_imgs:
-                page_imgs.sort(key=lambda x: x[0], reverse=True)
-                for area, raw, ext in page_imgs[:MAX_IMGS_PER_PAGE]:
-                    data_url, w2, h2, area2 = _b64_data_url(raw, prefer_format=ext)
-                    out.append({
-                        "kind": "image",
-                        "data_url": data_url,
-                        "page": page_idx,
-                        "width": w2,
-                        "height": h2,
-                        "area": area2,
-                        "caption": None
-                    })
+def _ingest_pdf_range(path: str, start: int, stop: int) -> List[Tuple[List[Dict[str, Any]], List[str], List[int]]]:
+    """
+    Tarea del pool: abre su propio documento y procesa las páginas [start, stop).
+    La deduplicación es local al rango; la global la resuelve el proceso padre, que con
+    los `spares` de cada página puede completar el cupo como lo haría la ingesta en serie.
+    Las imágenes se transcodifican aquí, así que al padre solo viajan bytes compactos.
+    """
+    pages: List[Tuple[List[Dict[str, Any]], List[str], List[int]]] = []
+    local_seen: set[str] = set()
+    local_xrefs: set[int] = set()
+    doc = fitz.open(path)
+    try:
+        for page_no in range(start, stop):
+            pages.append(_pdf_page_items(doc, doc[page_no], page_no + 1, local_seen, local_xrefs))
     finally:
         doc.close()
-    return out
 
+    by_page: Dict[int, List[Dict[str, Any]]] = {}
+    for it in _transcode_stream(it for page_items, _, _ in pages for it in page_items):
+        by_page.setdefault(it["page"], []).append(it)
+    return [
+        (by_page.get(page_no + 1, []), page_hashes, spares)
+        for page_no, (_, page_hashes, spares) in zip(range(start, stop), pages)
+    ]
 
-def _ingest_docx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
+
+def _ingest_pdf_parallel(path: str, page_count: int, seen_hashes: set[str], workers: int) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Reparte el PDF en rangos de INGEST_PAGES_PER_CHUNK páginas y los procesa en un pool de procesos.
+    Produce (page_no, items) en orden de página, por lo que el orden de salida y la
+    deduplicación entre páginas (`seen_hashes`) son deterministas. Solo se mantienen en
+    vuelo 2*workers rangos para acotar la memoria.
+    La salida es idéntica a la de la ingesta en serie: si la deduplicación global deja una
+    página por debajo de MAX_IMGS_PER_PAGE, el padre completa el cupo con sus candidatos
+    sobrantes (ver `_fill_page`).
+    """
+    ranges = iter([(s, min(s + INGEST_PAGES_PER_CHUNK, page_count)) for s in range(0, page_count, INGEST_PAGES_PER_CHUNK)])
+    n_workers = min(workers, -(-page_count // INGEST_PAGES_PER_CHUNK))
+    ctx = multiprocessing.get_context("spawn")
+    doc = None
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+        pending: Deque[Tuple[int, Future]] = deque(
+            (start, pool.submit(_ingest_pdf_range, path, start, stop))
+            for start, stop in islice(ranges, 2 * n_workers)
+        )
+        try:
+            while pending:
+                start, fut = pending.popleft()
+                chunk = fut.result()
+                nxt = next(ranges, None)
+                if nxt is not None:
+                    pending.append((nxt[0], pool.submit(_ingest_pdf_range, path, nxt[0], nxt[1])))
+                for offset, (page_items, page_hashes, spares) in enumerate(chunk):
+                    if not DEDUPLICATE_IMAGES:
+                        yield start + offset, page_items
+                        continue
+                    kept = [it for it in page_items if not (it["kind"] == "image" and it["hash"] in seen_hashes)]
+                    seen_hashes.update(page_hashes)
+                    if len(kept) < len(page_items) and spares:
+                        if doc is None:
+                            doc = fitz.open(path)
+                        kept += _fill_page(doc, start + offset + 1, spares,
+                                           len(page_items) - len(kept), seen_hashes)
+                    yield start + offset, kept
+        finally:
+            for _, fut in pending:
+                fut.cancel()
+            if doc is not None:
+                doc.close()
+
+
+def _fill_page(doc, page_idx: int, spares: List[int], room: int, seen_hashes: set[str]) -> List[Dict[str, Any]]:
+    # Huecos que dejó la deduplicación global: se cubren con los siguientes candidatos de la página
+    page_imgs, _ = _take_page_images(doc, spares, room, seen_hashes, set())
+    return [_pending_image(raw, ext, page_idx, hsh) for raw, ext, hsh in page_imgs]
+
+
+def _ingest_docx(path: str, seen_hashes: set[str]) -> Iterator[Dict[str, Any]]:
     doc = DocxDocument(path)
 
     texts = []
@@ -123,11 +380,11 @@ def _ingest_docx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
             texts.append(p.text)
     full_text = "\n".join(texts).strip()
     if full_text:
-        out.append({"kind": "text", "text": full_text, "page": 1})
+        yield {"kind": "text", "text": full_text, "page": 1}
 
     try:
         rels = doc.part._rels
-        page_imgs: List[Tuple[int, bytes, str]] = []
+        page_imgs: List[Tuple[int, bytes, str, str]] = []
         for rel in rels.values():
             if "image" in rel.target_ref or ("/media/" in rel.target_ref):
                 part = rel._target
@@ -140,31 +397,19 @@ def _ingest_docx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
                     area = w * h
                 if area < MIN_IMAGE_AREA:
                     continue
-                page_imgs.append((area, blob, "jpeg"))
+                page_imgs.append((area, blob, "jpeg", hsh))
                 if DEDUPLICATE_IMAGES:
                     seen_hashes.add(hsh)
 
         if page_imgs:
             page_imgs.sort(key=lambda x: x[0], reverse=True)
-            for area, raw, ext in page_imgs[:MAX_IMGS_PER_PAGE]:
-                data_url, w2, h2, area2 = _b64_data_url(raw, prefer_format=ext)
-                out.append({
-                    "kind": "image",
-                    "data_url": data_url,
-                    "page": 1,
-                    "width": w2,
-                    "height": h2,
-                    "area": area2,
-                    "caption": None
-                })
+            for area, raw, ext, hsh in page_imgs[:MAX_IMGS_PER_PAGE]:
+                yield _pending_image(raw, ext, 1, hsh)
     except Exception:
         pass
 
-    return out
 
-
-def _ingest_pptx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
+def _ingest_pptx(path: str, seen_hashes: set[str]) -> Iterator[Dict[str, Any]]:
     prs = Presentation(path)
     for idx, slide in enumerate(prs.slides, start=1):
         texts = []
@@ -174,9 +419,9 @@ def _ingest_pptx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
                 if t.strip():
                     texts.append(t)
         if texts:
-            out.append({"kind": "text", "text": "\n".join(texts), "page": idx})
+            yield {"kind": "text", "text": "\n".join(texts), "page": idx}
 
-        slide_imgs: List[Tuple[int, bytes, str]] = []
+        slide_imgs: List[Tuple[int, bytes, str, str]] = []
         for shape in slide.shapes:
             if shape.shape_type == 13:  # PICTURE
                 try:
@@ -190,7 +435,7 @@ def _ingest_pptx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
                         area = w * h
                     if area < MIN_IMAGE_AREA:
                         continue
-                    slide_imgs.append((area, blob, (img.ext or "jpeg").lower()))
+                    slide_imgs.append((area, blob, (img.ext or "jpeg").lower(), hsh))
                     if DEDUPLICATE_IMAGES:
                         seen_hashes.add(hsh)
                 except Exception:
@@ -198,15 +443,5 @@ def _ingest_pptx(path: str, seen_hashes: set[str]) -> List[Dict[str, Any]]:
 
         if slide_imgs:
             slide_imgs.sort(key=lambda x: x[0], reverse=True)
-            for area, raw, ext in slide_imgs[:MAX_IMGS_PER_PAGE]:
-                data_url, w2, h2, area2 = _b64_data_url(raw, prefer_format=ext)
-                out.append({
-                    "kind": "image",
-                    "data_url": data_url,
-                    "page": idx,
-                    "width": w2,
-                    "height": h2,
-                    "area": area2,
-                    "caption": None
-                })
-    return out
+            for area, raw, ext, hsh in slide_imgs[:MAX_IMGS_PER_PAGE]:
+                yield _pending_image(raw, ext, idx, hsh)
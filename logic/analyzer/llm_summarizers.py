@@ -1,8 +1,12 @@
 # logic/analyzer/llm_summarizers.py
 from __future__ import annotations
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from openai import OpenAI
 
+from config import LLM_CACHE_MODE
+from logic.llm_client import cached_chat_text
+from logic.analyzer.scheduler import RateLimiter
+
 
 SUMMARY_SYSTEM_PROMPT = (
     "Eres un analista experto. A partir del contenido (texto e imágenes) produce un resumen "
@@ -17,11 +21,16 @@ AGGREGATE_SYSTEM_PROMPT = (
 )
 
 
-def summarize_block(client: OpenAI, model: str, content: List[Dict[str, Any]], temperature: float = 0.2) -> str:
+def summarize_block(client: OpenAI, model: str, content: List[Dict[str, Any]], temperature: float = 0.2,
+                    limiter: Optional[RateLimiter] = None, est_tokens: int = 0,
+                    cache_mode: str = LLM_CACHE_MODE) -> str:
     """
     Hace una llamada multimodal (texto + image_url) para producir un resumen denso del bloque.
+    Si se pasa `limiter`, reserva `est_tokens` antes y lo ajusta con el uso real después.
+    Un bloque idéntico ya resumido se sirve desde la caché de respuestas (ver `cache_mode`).
     """
-    resp = client.chat.completions.create(
+    return cached_chat_text(
+        client, limiter, est_tokens, cache_mode,
         model=model,
         messages=[
             {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
@@ -29,15 +38,17 @@ def summarize_block(client: OpenAI, model: str, content: List[Dict[str, Any]], t
         ],
         temperature=temperature,
     )
-    return resp.choices[0].message.content.strip()
 
 
-def aggregate_summaries(client: OpenAI, model: str, partial_summaries: List[str], temperature: float = 0.2) -> str:
+def aggregate_summaries(client: OpenAI, model: str, partial_summaries: List[str], temperature: float = 0.2,
+                        limiter: Optional[RateLimiter] = None, est_tokens: int = 0,
+                        cache_mode: str = LLM_CACHE_MODE) -> str:
     """
     Opcional: comprime una lista de resúmenes parciales en uno solo más corto.
     """
     joined = "\n\n---\n\n".join(partial_summaries)
-    resp = client.chat.completions.create(
+    return cached_chat_text(
+        client, limiter, est_tokens, cache_mode,
         model=model,
         messages=[
             {"role": "system", "content": AGGREGATE_SYSTEM_PROMPT},
@@ -45,4 +56,3 @@ def aggregate_summaries(client: OpenAI, model: str, partial_summaries: List[str]
         ],
         temperature=temperature,
     )
-    return resp.choices[0].message.content.strip()
@@ -1,10 +1,24 @@
 # logic/analyzer/ocr.py
 from __future__ import annotations
-import base64
-from typing import List, Dict, Any, Optional
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Deque, Tuple
 
-from config import OCR_MODE, OCR_ENABLED, OCR_LANG, OCR_TEXT_MAX_CHARS, OCR_TOKEN_ESTIMATE
+from config import (
+    OCR_MODE, OCR_ENABLED, OCR_LANG, OCR_TEXT_MAX_CHARS, OCR_TOKEN_ESTIMATE, LLM_CACHE_MODE,
+    OCR_WORKERS, OCR_LLM_CONCURRENCY, OCR_LLM_MODEL, OCR_CACHE_ENABLED, OCR_CACHE_MAX_MB,
+    OCR_TEXT_DETECTION, OCR_TEXT_MIN_CELLS
+)
 from openai import OpenAI
+from logic.llm_client import cached_chat_text, CACHE_USE, CACHE_OFF
+from logic.analyzer.cache import DiskCache, get_cache
+from logic.analyzer.images import ImageRef, count_text_cells
+from logic.analyzer.scheduler import RateLimiter
 
 
 def _pytesseract_available() -> bool:
@@ -27,65 +41,278 @@ def _ocr_local(image_bytes: bytes, lang: str = OCR_LANG) -> Optional[str]:
         return None
 
 
-def _ocr_llm(client: OpenAI, data_url: str) -> Optional[str]:
+def _has_text(image_bytes: bytes) -> bool:
+    """Pre-clasificador local: solo merece la pena hacer OCR si la imagen parece tener texto."""
+    return count_text_cells(image_bytes) >= OCR_TEXT_MIN_CELLS
+
+
+def _ocr_llm(client: OpenAI, data_url: str, limiter: Optional[RateLimiter] = None,
+             cache_mode: str = LLM_CACHE_MODE) -> Optional[str]:
     try:
         # Petición mínima al modelo visión para transcribir texto lo más fiel posible.
         messages = [
             {"role": "system", "content": "Transcribe exactamente todo el texto visible en la imagen. No agregues comentarios. Devuelve solo el texto crudo."},
             {"role": "user", "content": [{"type": "image_url", "image_url": {"url": data_url}}]},
         ]
-        resp = client.chat.completions.create(
-            model="gpt-4.1-mini",
+        # respeta presupuesto estimado; la misma imagen ya transcrita sale de la caché
+        return cached_chat_text(
+            client, limiter, OCR_TOKEN_ESTIMATE, cache_mode,
+            model=OCR_LLM_MODEL,
             messages=messages,
             temperature=0.0,
         )
-        return (resp.choices[0].message.content or "").strip()
     except Exception:
         return None
 
 
-def _data_url_to_bytes(data_url: str) -> Optional[bytes]:
-    try:
-        header, b64 = data_url.split(",", 1)
-        return base64.b64decode(b64)
-    except Exception:
-        return None
+def ocr_cache() -> DiskCache:
+    """Caché en disco de textos OCR por hash de imagen + motor + idioma/modelo (LRU por tamaño)."""
+    return get_cache("ocr", OCR_CACHE_MAX_MB)
+
 
+def _ocr_cache_key(engine: str, variant: str, img_hash: str) -> str:
+    # variant: idioma de tesseract para "local", modelo para "llm"
+    return f"{engine}:{variant}:{img_hash}"
 
-def apply_ocr_to_items(items: List[Dict[str, Any]], client: OpenAI | None, allow_fn) -> None:
+
+def apply_ocr_to_items(items: List[Dict[str, Any]], client: OpenAI | None, limiter: Optional[RateLimiter],
+                       cache_mode: str = LLM_CACHE_MODE) -> None:
     """
     Enriquecer items de imagen con campo 'ocr' si OCR está habilitado.
     - Usa OCR local (tesseract) cuando está disponible y OCR_MODE lo permite.
-    - Si no, usa OCR vía LLM (requiere client). La función `allow_fn(tokens)` debe
-      respetar el presupuesto (TPM/RPM) cuando se use el modo LLM.
+    - Si no, usa OCR vía LLM (requiere client). El `limiter` reparte el presupuesto
+      (TPM/RPM) cuando se use el modo LLM.
     Nota: modifica 'items' in-place.
     """
+    for _ in iter_ocr_items(items, client, limiter, cache_mode):
+        pass
+
+
+def iter_ocr_items(items: Iterable[Dict[str, Any]], client: OpenAI | None, limiter: Optional[RateLimiter],
+                   cache_mode: str = LLM_CACHE_MODE) -> Iterator[Dict[str, Any]]:
+    """
+    Versión en streaming de `apply_ocr_to_items`: enriquece cada item de imagen
+    (in-place) y lo reenvía, de modo que la siguiente etapa no espera al documento completo.
+    Antes, un detector local barato descarta las imágenes sin texto aparente.
+    El OCR local se reparte en un pool de OCR_WORKERS procesos; las imágenes en las que
+    falla (o sin tesseract) pasan al OCR vía LLM en un pool de hilos aparte, así que ambos
+    se solapan. Los items salen en el mismo orden en que entran.
+    """
     if not OCR_ENABLED:
+        yield from items
         return
 
     use_local = (OCR_MODE in ("auto", "local")) and _pytesseract_available()
     use_llm = (OCR_MODE in ("auto", "llm")) and client is not None
+    if not (use_local or use_llm):
+        yield from items
+        return
+
+    ocr = _OcrDispatcher(client, limiter, use_local, use_llm, cache_mode)
+    pending: Deque[Tuple[Dict[str, Any], Optional[Future]]] = deque()
+    try:
+        for it in items:
+            fut = ocr.submit(it) if (it.get("kind") == "image" and not it.get("ocr")) else None
+            pending.append((it, fut))
+            # Ventana acotada: no se adelanta la ingesta más de lo que el OCR puede absorber
+            while len(pending) > 4 * max(1, OCR_WORKERS) or (pending and _is_ready(pending[0][1])):
+                yield _finish(*pending.popleft())
+        while pending:
+            yield _finish(*pending.popleft())
+    finally:
+        ocr.shutdown()
+
+
+def _is_ready(fut: Optional[Future]) -> bool:
+    return fut is None or fut.done()
+
+
+def _finish(it: Dict[str, Any], fut: Optional[Future]) -> Dict[str, Any]:
+    text = fut.result() if fut is not None else None
+    if text:
+        it["ocr"] = text[:OCR_TEXT_MAX_CHARS]
+    return it
+
+
+_local_pool: Optional[Executor] = None
+_local_lock = threading.Lock()
+
+
+def local_ocr_pool() -> Executor:
+    """
+    Pool compartido por todo el proceso para tesseract: procesos (spawn) si hay más de un
+    núcleo disponible, o un único hilo. Cada hijo tarda ~1 s en importar sus dependencias,
+    así que se crea una sola vez y lo reutilizan todos los archivos.
+    """
+    global _local_pool
+    with _local_lock:
+        if _local_pool is None:
+            workers = min(OCR_WORKERS, os.cpu_count() or 1)
+            if workers > 1:
+                ctx = multiprocessing.get_context("spawn")
+                _local_pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+            else:
+                _local_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr-local")
+        return _local_pool
+
+
+class _OcrDispatcher:
+    """
+    Lanza el OCR de cada imagen y devuelve un Future con el texto (o None).
+    El OCR local va al pool compartido de tesseract (`local_ocr_pool`); si no da texto, la
+    misma imagen se encola en el pool de hilos del OCR vía LLM, sin esperar a las imágenes
+    anteriores. La detección de texto, el tesseract de respaldo (si el pool de procesos no
+    está disponible) y el tratamiento de cada resultado local (caché en SQLite, base64 para
+    el LLM) van a un pool de hilos propio de CPU: ni detrás de las llamadas al LLM, que
+    pueden quedar bloqueadas en el limitador o la red, ni en el hilo de resultados del
+    pool de procesos. Los pools propios se crean al primer uso.
+    """
+    def __init__(self, client: OpenAI | None, limiter: Optional[RateLimiter], use_local: bool, use_llm: bool,
+                 cache_mode: str):
+        self.client = client
+        self.limiter = limiter
+        self.use_local = use_local
+        self.use_llm = use_llm
+        self.cache_mode = cache_mode
+        self._local_futures: set = set()
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._cpu_pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending: set = set()
+
+    def _threads(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(max_workers=max(1, OCR_LLM_CONCURRENCY), thread_name_prefix="ocr")
+            return self._thread_pool
+
+    def _cpu(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._cpu_pool is None:
+                self._cpu_pool = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr-cpu")
+            return self._cpu_pool
+
+    def submit(self, it: Dict[str, Any]) -> Optional[Future]:
+        ref: Optional[ImageRef] = it.get("image")
+        if ref is None:
+            return None
+        result: Future = Future()
+        with self._lock:
+            self._pending.add(result)
+        if OCR_TEXT_DETECTION:
+            # Fotos y gráficos sin texto no pasan por tesseract ni, sobre todo, por el LLM
+            detect = self._cpu().submit(_has_text, ref.data)
+            detect.add_done_callback(lambda f: self._on_detect(f, ref, result))
+        else:
+            self._start(ref, result)
+        return result
+
+    def _on_detect(self, f: Future, ref: ImageRef, result: Future) -> None:
+        if f.exception() is None and not f.result():
+            self._resolve(result, None)
+        else:
+            self._start(ref, result)
+
+    def _start(self, ref: ImageRef, result: Future) -> None:
+        # Hash de los bytes exactos que ve el OCR (imagen ya transcodificada)
+        img_hash = hashlib.sha1(ref.data).hexdigest()
+        if self.use_local:
+            self._submit_local(ref, img_hash, result)
+        else:
+            self._submit_llm(ref, img_hash, result)
+
+    def _submit_local(self, ref: ImageRef, img_hash: str, result: Future) -> None:
+        key = _ocr_cache_key("local", OCR_LANG, img_hash)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self._after_local(cached, ref, img_hash, result)
+            return
+        # Los bytes se pasan directo a tesseract, sin pasar por base64
+        try:
+            local = local_ocr_pool().submit(_ocr_local, ref.data, OCR_LANG)
+        except BrokenProcessPool:
+            local = self._cpu().submit(_ocr_local, ref.data, OCR_LANG)
+        with self._lock:
+            self._local_futures.add(local)
+        local.add_done_callback(lambda f: self._defer(self._on_local, f, ref, img_hash, key, result))
+
+    def _defer(self, fn, *args) -> None:
+        # Los callbacks corren en el hilo de resultados del pool: el trabajo sigue en `_cpu`
+        try:
+            self._cpu().submit(fn, *args)
+        except RuntimeError:
+            # Pool cerrado: `shutdown` ya resolvió las imágenes pendientes
+            pass
+
+    def _on_local(self, f: Future, ref: ImageRef, img_hash: str, key: str, result: Future) -> None:
+        with self._lock:
+            self._local_futures.discard(f)
+        if result.done() or f.cancelled():
+            return
+        exc = f.exception()
+        if isinstance(exc, BrokenProcessPool):
+            # Entorno sin soporte de subprocesos: la misma imagen se procesa en un hilo
+            retry = self._cpu().submit(_ocr_local, ref.data, OCR_LANG)
+            retry.add_done_callback(lambda g: self._defer(self._on_local, g, ref, img_hash, key, result))
+            return
+        text = None if exc is not None else f.result()
+        self._cache_set(key, text)
+        self._after_local(text, ref, img_hash, result)
+
+    def _after_local(self, text: Optional[str], ref: ImageRef, img_hash: str, result: Future) -> None:
+        if not text and self.use_llm:
+            self._submit_llm(ref, img_hash, result)
+        else:
+            self._resolve(result, text)
+
+    def _resolve(self, result: Future, text: Optional[str]) -> None:
+        # `shutdown` puede haberlo resuelto ya si el consumidor dejó de leer
+        with self._lock:
+            self._pending.discard(result)
+            if not result.done():
+                result.set_result(text)
+
+    def _submit_llm(self, ref: ImageRef, img_hash: str, result: Future) -> None:
+        key = _ocr_cache_key("llm", OCR_LLM_MODEL, img_hash)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self._resolve(result, cached)
+            return
+        try:
+            llm = self._threads().submit(_ocr_llm, self.client, ref.to_data_url(), self.limiter, self.cache_mode)
+        except RuntimeError:
+            # Pool cerrado (el consumidor dejó de leer)
+            self._resolve(result, None)
+            return
+        llm.add_done_callback(lambda f: self._on_llm(f, key, result))
+
+    def _on_llm(self, f: Future, key: str, result: Future) -> None:
+        text = None if f.exception() is not None else f.result()
+        self._cache_set(key, text)
+        self._resolve(result, text)
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        # Mismo significado que en la caché de respuestas: "refresh" no lee, "off" ni lee ni escribe
+        if not OCR_CACHE_ENABLED or self.cache_mode != CACHE_USE:
+            return None
+        raw = ocr_cache().get(key)
+        return raw.decode("utf-8") if raw is not None else None
+
+    def _cache_set(self, key: str, text: Optional[str]) -> None:
+        # None = fallo (no se guarda); "" = la imagen no tiene texto (sí se guarda)
+        if text is None or not OCR_CACHE_ENABLED or self.cache_mode == CACHE_OFF:
+            return
+        ocr_cache().set(key, text.encode("utf-8"))
 
-    for it in items:
-        if it.get("kind") != "image":
-            continue
-        if it.get("ocr"):
-            continue  # ya tiene ocr
-
-        data_url = it.get("data_url")
-        if not data_url:
-            continue
-
-        text: Optional[str] = None
-        if use_local:
-            raw = _data_url_to_bytes(data_url)
-            if raw:
-                text = _ocr_local(raw, lang=OCR_LANG)
-
-        if (not text) and use_llm:
-            # respeta presupuesto estimado
-            allow_fn(OCR_TOKEN_ESTIMATE)
-            text = _ocr_llm(client, data_url)
-
-        if text:
-            it["ocr"] = text[:OCR_TEXT_MAX_CHARS]
+    def shutdown(self) -> None:
+        with self._lock:
+            pending = list(self._pending)
+            local = list(self._local_futures)
+        for fut in pending:
+            self._resolve(fut, None)
+        # El pool de tesseract es compartido: solo se cancelan las imágenes propias aún en cola
+        for fut in local:
+            fut.cancel()
+        for pool in (self._cpu_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
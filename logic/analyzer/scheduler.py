@@ -1,42 +1,198 @@
 # logic/analyzer/scheduler.py
 from __future__ import annotations
 import time
-from typing import Optional
-from config import TPM_BUDGET, RPM_BUDGET, COOLDOWN_MS
+import threading
+from typing import Any, Optional
+from config import TPM_BUDGET, RPM_BUDGET, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_S
 
 
 class RateLimiter:
     """
-    Limitador simple por ventana deslizante de 60s para tokens y requests.
+    Limitador de cubeta de tokens continua (estilo GCRA) para tokens y requests por minuto.
+    El presupuesto se repone de forma continua (TPM/60 por segundo) en lugar de reiniciarse
+    de golpe cada 60s, igual que el limitador del propio servidor.
+    Es seguro para llamadas concurrentes: cada llamada reserva su coste al entrar (el saldo
+    puede quedar negativo) y espera lo justo hasta que la deuda se repone, así que los
+    turnos se respetan en orden de llegada sin sondeos.
+    Las estimaciones (len/4) se corrigen con el uso real devuelto por la API (`reconcile`).
     """
-    def __init__(self, tpm_budget: int = TPM_BUDGET, rpm_budget: int = RPM_BUDGET, cooldown_ms: int = COOLDOWN_MS):
+    def __init__(self, tpm_budget: int = TPM_BUDGET, rpm_budget: int = RPM_BUDGET):
         self.tpm = tpm_budget
         self.rpm = rpm_budget
-        self.cooldown_ms = cooldown_ms
 
-        self._win_start = time.time()
-        self._tokens_used = 0
-        self._reqs_used = 0
+        self._lock = threading.Lock()
+        self._tokens = float(tpm_budget)
+        self._reqs = float(rpm_budget)
+        self._last = time.monotonic()
+        # Relación medida entre tokens reales y estimados (media móvil)
+        self._ratio = 1.0
+        # Pausa global impuesta por un 429 (Retry-After)
+        self._blocked_until = 0.0
 
-    def _rollover(self):
-        now = time.time()
-        if now - self._win_start >= 60.0:
-            self._win_start = now
-            self._tokens_used = 0
-            self._reqs_used = 0
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+        self._reqs = min(float(self.rpm), self._reqs + elapsed * self.rpm / 60.0)
 
-    def allow(self, tokens_needed: int):
+    def allow(self, tokens_needed: int) -> int:
         """
         Bloquea hasta que haya presupuesto suficiente para consumir tokens_needed y 1 request.
+        Devuelve los tokens realmente cargados (la estimación corregida por el uso medido).
         """
-        while True:
-            self._rollover()
-            if (self._tokens_used + tokens_needed <= self.tpm) and (self._reqs_used + 1 <= self.rpm):
-                self._tokens_used += tokens_needed
-                self._reqs_used += 1
-                if self.cooldown_ms > 0:
-                    time.sleep(self.cooldown_ms / 1000.0)
-                return
-            # dormir hasta siguiente ventana (o hasta liberar tokens)
-            to_wait = max(0.1, 60.0 - (time.time() - self._win_start))
-            time.sleep(min(2.0, to_wait))
+        with self._lock:
+            self._refill()
+            charged = int(min(self.tpm, max(1, tokens_needed * self._ratio)))
+            self._tokens -= charged
+            self._reqs -= 1
+            wait = max(0.0, -self._tokens * 60.0 / self.tpm, -self._reqs * 60.0 / self.rpm,
+                       self._blocked_until - time.monotonic())
+        if wait > 0:
+            time.sleep(wait)
+        return charged
+
+    def reconcile(self, estimated: int, charged: int, usage: Any) -> None:
+        """
+        Ajusta el saldo con el uso real (`response.usage`) de una llamada ya autorizada:
+        devuelve lo cobrado de más o descuenta lo que faltó, y actualiza la relación
+        real/estimado que se aplica a las siguientes reservas.
+        """
+        actual = getattr(usage, "total_tokens", None) if usage is not None else None
+        if not actual:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens -= actual - charged
+            if estimated > 0:
+                ratio = min(4.0, max(0.25, actual / float(estimated)))
+                self._ratio = 0.8 * self._ratio + 0.2 * ratio
+
+
+    def refund(self, tokens: int) -> None:
+        """Devuelve lo reservado por una llamada que no llegó a consumir presupuesto (5xx, error de conexión)."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(float(self.tpm), self._tokens + tokens)
+            self._reqs = min(float(self.rpm), self._reqs + 1)
+
+    def observe_headers(self, headers: Any) -> None:
+        """
+        Sincroniza el saldo con las cabeceras x-ratelimit-remaining-* del servidor.
+        Solo puede bajarlo: si el servidor ve menos margen que nosotros, manda el servidor.
+        """
+        remaining = {}
+        for kind in ("tokens", "requests"):
+            try:
+                remaining[kind] = float(headers.get(f"x-ratelimit-remaining-{kind}"))
+            except (TypeError, ValueError):
+                continue
+        if not remaining:
+            return
+        with self._lock:
+            self._refill()
+            if "tokens" in remaining:
+                self._tokens = min(self._tokens, remaining["tokens"])
+            if "requests" in remaining:
+                self._reqs = min(self._reqs, remaining["requests"])
+
+    def pause(self, seconds: float) -> None:
+        """Detiene todas las reservas durante `seconds` (p.ej. tras un 429 con Retry-After)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class CircuitOpenError(Exception):
+    """La API ha fallado repetidamente: se rechaza la llamada sin intentarla."""
+
+
+class CircuitBreaker:
+    """
+    Cortocircuito para caídas sostenidas: tras `threshold` llamadas seguidas que agotaron
+    sus reintentos (5xx o de conexión) se abre y rechaza llamadas nuevas durante `reset_s`
+    segundos; después deja pasar una sola de prueba (semiabierto) mientras las demás siguen
+    rechazándose. Si la prueba tiene éxito se cierra; si falla, vuelve a abrirse otros
+    `reset_s` segundos.
+    Una llamada que ya estaba reintentando no se rechaza al abrirse: espera (`wait=True`)
+    a que pase `reset_s` y hace ella la prueba, o espera el resultado de la prueba en curso.
+    """
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_s: float = CIRCUIT_RESET_S):
+        self.threshold = threshold
+        self.reset_s = reset_s
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # Semiabierto: ya hay una llamada de prueba en curso
+        self._probing = False
+
+    def before_call(self, wait: bool = False) -> bool:
+        """
+        Autoriza una llamada; devuelve True si es la llamada de prueba del estado semiabierto.
+        Con el circuito abierto lanza CircuitOpenError, salvo con `wait`, que espera hasta
+        poder probar o a que otra prueba lo cierre (si esa prueba falla, se lanza igualmente).
+        """
+        with self._cond:
+            started = self._opened_at
+            while True:
+                if self._opened_at is None:
+                    return False
+                if self._opened_at != started:
+                    # La prueba en curso falló: la caída dura más que los reintentos
+                    wait = False
+                remaining = self.reset_s - (time.monotonic() - self._opened_at)
+                if remaining <= 0 and not self._probing:
+                    self._probing = True
+                    return True
+                if not wait:
+                    raise CircuitOpenError(
+                        f"La API de OpenAI no responde tras {self._failures} llamadas fallidas seguidas; "
+                        f"se reintentará en {max(1, int(remaining))} s."
+                    )
+                self._cond.wait(remaining if remaining > 0 else None)
+
+    def record_success(self) -> None:
+        with self._cond:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            self._cond.notify_all()
+
+    def record_failure(self) -> None:
+        """Una llamada agotó sus reintentos, o falló la prueba del estado semiabierto."""
+        with self._cond:
+            self._failures += 1
+            if self._failures >= self.threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+            self._probing = False
+            self._cond.notify_all()
+
+    def release(self) -> None:
+        """La prueba terminó sin indicar si el servicio está caído (p.ej. 429 o 400): otra puede probar."""
+        with self._cond:
+            self._probing = False
+            self._cond.notify_all()
+
+
+_shared: Optional[RateLimiter] = None
+_shared_lock = threading.Lock()
+
+
+def shared_limiter() -> RateLimiter:
+    """Limitador único del proceso: lo comparten el análisis y la generación de exámenes."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = RateLimiter()
+        return _shared
+
+
+_breaker: Optional[CircuitBreaker] = None
+
+
+def shared_breaker() -> CircuitBreaker:
+    """Cortocircuito único del proceso, compartido por todas las llamadas a la API."""
+    global _breaker
+    with _shared_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker()
+        return _breaker
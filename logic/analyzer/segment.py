@@ -1,6 +1,7 @@
 # logic/analyzer/segment.py
 from __future__ import annotations
-from typing import List, Dict, Any
+import hashlib
+from typing import List, Dict, Any, Iterable, Iterator
 from config import (
     TOKENS_PER_BLOCK_MIN, TOKENS_PER_BLOCK_MAX,
     MAX_IMGS_PER_BLOCK, IMAGE_TOKEN_EQUIV, OCR_TEXT_MAX_CHARS
@@ -31,7 +32,14 @@ def segment_items_to_blocks(items: List[Dict[str, Any]]) -> List[List[Dict[str,
     Agrupa items respetando tamaño de tokens y un máximo de imágenes por bloque.
     Las imágenes extra se omiten (no crean bloques nuevos).
     """
-    blocks: List[List[Dict[str, Any]]] = []
+    return list(iter_blocks(items))
+
+
+def iter_blocks(items: Iterable[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Versión en streaming de `segment_items_to_blocks`: cada bloque se produce en cuanto
+    se cierra, así que solo el bloque en curso permanece en memoria.
+    """
     current: List[Dict[str, Any]] = []
     current_cost = 0
     current_imgs = 0
@@ -44,7 +52,7 @@ def segment_items_to_blocks(items: List[Dict[str, Any]]) -> List[List[Dict[str,
 
         cost = _item_cost(it)
         if current and (current_cost + cost > TOKENS_PER_BLOCK_MAX):
-            blocks.append(current)
+            yield current
             current = []
             current_cost = 0
             current_imgs = 0
@@ -55,15 +63,13 @@ def segment_items_to_blocks(items: List[Dict[str, Any]]) -> List[List[Dict[str,
             current_imgs += 1
 
         if current_cost >= TOKENS_PER_BLOCK_MIN:
-            blocks.append(current)
+            yield current
             current = []
             current_cost = 0
             current_imgs = 0
 
     if current:
-        blocks.append(current)
-
-    return blocks
+        yield current
 
 
 def block_to_chat_content(block: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -80,7 +86,8 @@ def block_to_chat_content(block: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
             if text.strip():
                 content.append({"type": "text", "text": text})
         else:
-            data_url: str = it["data_url"]
+            # base64 solo aquí, en el último momento antes de enviar
+            data_url = it["image"].to_data_url()
             content.append({"type": "image_url", "image_url": {"url": data_url}})
             ocr_text = (it.get("ocr") or "").strip()
             if ocr_text:
@@ -92,3 +99,17 @@ def block_to_chat_content(block: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
 def block_cost_tokens(block: List[Dict[str, Any]]) -> int:
     return sum(_item_cost(it) for it in block)
+
+
+def block_fingerprint(block: List[Dict[str, Any]]) -> str:
+    """
+    Huella estable del contenido de un bloque (textos + hash de origen de sus imágenes).
+    Dos bloques con la misma huella producen la misma petición de resumen.
+    """
+    h = hashlib.sha256()
+    for it in block:
+        if it["kind"] == "text":
+            h.update(b"t\0" + (it.get("text") or "").encode("utf-8") + b"\0")
+        else:
+            h.update(b"i\0" + str(it.get("hash") or "").encode("ascii") + b"\0")
+    return h.hexdigest()
@@ -1,112 +1,373 @@
 # logic/analyzer/semantic.py
 from __future__ import annotations
 import re
-from typing import List, Dict, Any
+import abc
+import math
+import zlib
+import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
+import numpy as np
 from openai import OpenAI
+from logic.llm_client import create_embeddings
+from logic.analyzer.cache import DiskCache, get_cache
+from logic.analyzer.scheduler import RateLimiter
 from config import (
-    SEMANTIC_SPLIT_ENABLED, EMBEDDINGS_MODEL,
+    SEMANTIC_SPLIT_ENABLED, EMBEDDINGS_MODEL, EMBEDDINGS_BACKEND,
+    LOCAL_EMBEDDINGS_DIM, LOCAL_EMBEDDINGS_SIM_THRESHOLD,
+    EMBEDDINGS_CACHE_ENABLED, EMBEDDINGS_CACHE_MAX_MB, EMBEDDINGS_CACHE_DTYPE,
+    EMBEDDINGS_BATCH_MAX_ITEMS, EMBEDDINGS_BATCH_MAX_TOKENS, EMBEDDINGS_CONCURRENCY,
     SEMANTIC_SIM_THRESHOLD, SEMANTIC_MIN_TOKENS,
-    SEMANTIC_TARGET_TOKENS, SEMANTIC_MAX_SENTENCES,
+    SEMANTIC_TARGET_TOKENS, SEMANTIC_WINDOW_SENTENCES, SEMANTIC_TILING_WINDOW,
     TOKENS_PER_BLOCK_MAX
 )
 
 
 _SENTENCE_RE = re.compile(r'(?<=[\.\!\?])\s+(?=[A-ZÁÉÍÓÚÑÜ0-9])')
+_WORD_RE = re.compile(r"\w+")
 
 
 def _approx_tokens(s: str) -> int:
     return max(1, int(len(s) / 4))
 
 
-def _cosine(a: List[float], b: List[float]) -> float:
-    import math
-    dot = sum(x*y for x, y in zip(a, b))
-    na = math.sqrt(sum(x*x for x in a))
-    nb = math.sqrt(sum(y*y for y in b))
-    if na == 0 or nb == 0:
-        return 0.0
-    return dot / (na * nb)
+def _normalize_rows(embs: np.ndarray) -> np.ndarray:
+    """Normaliza cada fila a norma L2 = 1 (las filas nulas quedan a cero)."""
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embs / norms
 
 
-def _embed_sentences(client: OpenAI, sentences: List[str]) -> List[List[float]]:
-    resp = client.embeddings.create(
+def _gap_similarities(embs: np.ndarray, k: int) -> np.ndarray:
+    """
+    Similitud en cada frontera entre oraciones, estilo TextTiling: coseno entre la media de
+    las `k` oraciones anteriores a la frontera i y la de las `k` siguientes (i = 1..n-1).
+    Todas las fronteras se calculan de una vez con sumas acumuladas; g[0] no se usa.
+    """
+    n = len(embs)
+    csum = np.vstack([np.zeros((1, embs.shape[1]), dtype=np.float32), np.cumsum(embs, axis=0)])
+    idx = np.arange(n)
+    left = _normalize_rows(csum[idx] - csum[np.maximum(idx - k, 0)])
+    right = _normalize_rows(csum[np.minimum(idx + k, n)] - csum[idx])
+    gaps = np.einsum("ij,ij->i", left, right)
+    gaps[0] = 1.0
+    return gaps
+
+
+# Penalización de un trozo por debajo de SEMANTIC_MIN_TOKENS (solo se acepta si no hay otra opción)
+_UNDERSIZED_COST = 1e6
+
+
+def _segment_starts(tokens: np.ndarray, gaps: np.ndarray, threshold: float) -> List[int]:
+    """
+    Segmentación óptima por programación dinámica: devuelve el índice de la primera
+    oración de cada trozo. Cada trozo cabe en SEMANTIC_TARGET_TOKENS (salvo una oración
+    suelta mayor) y todos menos el último alcanzan SEMANTIC_MIN_TOKENS si es posible.
+    Coste de un corte: 1 + (1 + g)/2, o solo (1 + g)/2 si g < `threshold` (cambio de tema),
+    así que se usan los mínimos trozos posibles y cada corte cae donde menos se parecen
+    los dos lados. La minimización interna es vectorizada sobre los candidatos.
+    """
+    n = len(tokens)
+    prefix = np.concatenate([[0], np.cumsum(tokens)])
+    cut = np.where(gaps < threshold, 0.0, 1.0) + 0.5 * (1.0 + gaps)
+    cut[0] = 0.0
+    best = np.zeros(n + 1)
+    back = np.zeros(n + 1, dtype=np.int64)
+    for j in range(1, n + 1):
+        lo = min(int(np.searchsorted(prefix, prefix[j] - SEMANTIC_TARGET_TOKENS, "left")), j - 1)
+        cand = best[lo:j] + cut[lo:j]
+        if j < n:
+            cand = cand + _UNDERSIZED_COST * ((prefix[j] - prefix[lo:j]) < SEMANTIC_MIN_TOKENS)
+        k = int(np.argmin(cand))
+        best[j] = cand[k]
+        back[j] = lo + k
+
+    starts: List[int] = []
+    j = n
+    while j > 0:
+        j = int(back[j])
+        starts.append(j)
+    return starts[::-1]
+
+
+def embedding_cache() -> DiskCache:
+    """Caché en disco de embeddings de oraciones (vectores como blobs float16/float32)."""
+    return get_cache("embeddings", EMBEDDINGS_CACHE_MAX_MB)
+
+
+def _embedding_key(sentence: str, model: str = EMBEDDINGS_MODEL) -> str:
+    digest = hashlib.sha256(sentence.encode("utf-8")).hexdigest()
+    return f"{model}:{EMBEDDINGS_CACHE_DTYPE}:{digest}"
+
+
+def _batches(sentences: List[str]) -> List[List[str]]:
+    """Agrupa oraciones consecutivas en lotes acotados en número y en tokens estimados."""
+    batches: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for s in sentences:
+        t = _approx_tokens(s)
+        if current and (len(current) >= EMBEDDINGS_BATCH_MAX_ITEMS or current_tokens + t > EMBEDDINGS_BATCH_MAX_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(s)
+        current_tokens += t
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _request_batch(client: OpenAI, batch: List[str], limiter: Optional[RateLimiter]) -> np.ndarray:
+    # Cada lote reserva su coste en el limitador y se reintenta por separado (ver `_call`)
+    resp = create_embeddings(
+        client, limiter, sum(_approx_tokens(s) for s in batch),
         model=EMBEDDINGS_MODEL,
-        input=sentences
+        input=batch
     )
-    return [d.embedding for d in resp.data]
+    data = sorted(resp.data, key=lambda d: d.index)
+    return np.asarray([d.embedding for d in data], dtype=np.float32)
+
+
+def _request_embeddings(client: OpenAI, sentences: List[str], limiter: Optional[RateLimiter] = None) -> np.ndarray:
+    """Pide los embeddings por lotes, con hasta EMBEDDINGS_CONCURRENCY lotes en vuelo, en orden."""
+    batches = _batches(sentences)
+    if len(batches) == 1 or EMBEDDINGS_CONCURRENCY <= 1:
+        return np.vstack([_request_batch(client, b, limiter) for b in batches])
+    with ThreadPoolExecutor(max_workers=min(EMBEDDINGS_CONCURRENCY, len(batches)),
+                            thread_name_prefix="embed") as pool:
+        return np.vstack(list(pool.map(lambda b: _request_batch(client, b, limiter), batches)))
 
 
-def _split_text_semantically(text: str, client: OpenAI) -> List[str]:
+# ---------- Backends de embeddings ----------
+
+class Embedder(abc.ABC):
     """
-    Divide un texto largo en chunks semánticos (por tema), respetando
-    un objetivo de tokens y un mínimo para cerrar el chunk.
+    Interfaz de los backends de embeddings del divisor semántico.
+    `embed` devuelve una matriz float32 (n_oraciones x dim), sin normalizar.
+    `sim_threshold` es el umbral de cambio de tema calibrado para su espacio vectorial.
     """
-    if _approx_tokens(text) <= 2 * TOKENS_PER_BLOCK_MAX:
-        return [text]
+    name = ""
+    sim_threshold = SEMANTIC_SIM_THRESHOLD
+    cacheable = False
 
-    # Separación sencilla por oraciones
-    sentences = _SENTENCE_RE.split(text.strip())
-    if len(sentences) > SEMANTIC_MAX_SENTENCES:
-        sentences = sentences[:SEMANTIC_MAX_SENTENCES]
+    @abc.abstractmethod
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        ...
 
-    if not sentences:
-        return [text]
 
-    embs = _embed_sentences(client, sentences)
+class OpenAIEmbedder(Embedder):
+    """Embeddings remotos (EMBEDDINGS_MODEL), por lotes y bajo el limitador compartido."""
+    name = EMBEDDINGS_MODEL
+    cacheable = True
 
-    chunks: List[str] = []
-    current: List[str] = [sentences[0]]
-    current_tokens = _approx_tokens(sentences[0])
-    last_emb = embs[0]
+    def __init__(self, client: OpenAI, limiter: Optional[RateLimiter] = None):
+        self.client = client
+        self.limiter = limiter
 
-    for s, e in zip(sentences[1:], embs[1:]):
-        sim = _cosine(last_emb, e)
-        s_tokens = _approx_tokens(s)
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        return _request_embeddings(self.client, sentences, self.limiter)
 
-        should_split = (
-            (sim < SEMANTIC_SIM_THRESHOLD and current_tokens >= SEMANTIC_MIN_TOKENS) or
-            (current_tokens + s_tokens > SEMANTIC_TARGET_TOKENS)
-        )
 
-        if should_split:
-            chunks.append(" ".join(current))
-            current = [s]
-            current_tokens = s_tokens
-        else:
-            current.append(s)
-            current_tokens += s_tokens
+# Posiciones no nulas por característica en la proyección aleatoria dispersa, derivadas
+# de un mismo hash con multiplicadores impares distintos (hashing universal)
+_PROJECTION_NNZ = 4
+_PROJECTION_MULT = np.array([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F], dtype=np.uint64)[:_PROJECTION_NNZ]
 
-        last_emb = e
 
-    if current:
-        chunks.append(" ".join(current))
+def _feature_projection(features: List[str], dim: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Columnas (n x NNZ) y signos ±1 deterministas a partir del CRC32 de cada característica."""
+    h = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint64, count=len(features))
+    mixed = (h[:, None] * _PROJECTION_MULT[None, :]) & np.uint64(0xFFFFFFFF)
+    cols = ((mixed >> np.uint64(8)) % np.uint64(dim)).astype(np.int64)
+    signs = np.where(mixed & np.uint64(1 << 31), 1.0, -1.0).astype(np.float32)
+    return cols, signs
+
+
+class LocalEmbedder(Embedder):
+    """
+    Embeddings locales, sin red: TF-IDF de palabras, raíces y bigramas con hashing, proyectado
+    a LOCAL_EMBEDDINGS_DIM dimensiones con una proyección aleatoria dispersa (±1).
+    El IDF se calcula sobre las oraciones de cada llamada (la ventana del divisor).
+    """
+    name = "local-hash"
+    sim_threshold = LOCAL_EMBEDDINGS_SIM_THRESHOLD
+
+    def __init__(self, dim: int = LOCAL_EMBEDDINGS_DIM):
+        self.dim = dim
+
+    def embed(self, sentences: List[str]) -> np.ndarray:
+        n = len(sentences)
+        rows: List[int] = []
+        fids: List[int] = []
+        tfs: List[float] = []
+        vocab: Dict[str, int] = {}
+        df: Counter = Counter()
+        for i, s in enumerate(sentences):
+            words = [w for w in _WORD_RE.findall(s.lower()) if len(w) > 2]
+            counts = Counter(words)
+            # Prefijo de 5 letras como raíz aproximada (matriz/matrices) y bigramas
+            counts.update(f"{w[:5]}~" for w in words if len(w) > 5)
+            counts.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+            df.update(counts.keys())
+            for f, c in counts.items():
+                rows.append(i)
+                fids.append(vocab.setdefault(f, len(vocab)))
+                tfs.append(1.0 + math.log(c))
+        if not fids:
+            return np.zeros((n, self.dim), dtype=np.float32)
+
+        # Proyección e IDF por característica distinta; luego se indexan por aparición
+        features = list(vocab)
+        cols, signs = _feature_projection(features, self.dim)
+        cols, signs = cols[fids], signs[fids]
+        idf = np.asarray([math.log((1 + n) / (1 + df[f])) + 1.0 for f in features], dtype=np.float32)
+        weights = np.asarray(tfs, dtype=np.float32) * idf[fids]
 
-    return chunks
+        flat = np.repeat(np.asarray(rows, dtype=np.int64) * self.dim, _PROJECTION_NNZ) + cols.ravel()
+        out = np.bincount(flat, weights=(weights[:, None] * signs).ravel(), minlength=n * self.dim)
+        return out.reshape(n, self.dim).astype(np.float32)
 
 
-def apply_semantic_split(items: List[Dict[str, Any]], client: OpenAI) -> List[Dict[str, Any]]:
+def make_embedder(client: Optional[OpenAI], limiter: Optional[RateLimiter] = None) -> Embedder:
+    """Backend según EMBEDDINGS_BACKEND ("openai" | "local"); sin cliente se usa el local."""
+    if EMBEDDINGS_BACKEND == "local" or client is None:
+        return LocalEmbedder()
+    return OpenAIEmbedder(client, limiter)
+
+
+def _embed_sentences(embedder: Embedder, sentences: List[str]) -> np.ndarray:
+    """
+    Devuelve una matriz float32 (n_oraciones x dim) con filas ya normalizadas.
+    Con la caché activa (backends remotos) solo se piden las oraciones que no estaban
+    guardadas (cada oración distinta una sola vez).
+    """
+    if not (EMBEDDINGS_CACHE_ENABLED and embedder.cacheable):
+        return _normalize_rows(embedder.embed(sentences))
+
+    cache = embedding_cache()
+    keys = [_embedding_key(s, embedder.name) for s in sentences]
+    found = cache.get_many(keys)
+
+    missing = list(dict.fromkeys(s for s, k in zip(sentences, keys) if k not in found))
+    fresh: Dict[str, np.ndarray] = {}
+    if missing:
+        vectors = embedder.embed(missing)
+        to_store = {}
+        for s, v in zip(missing, vectors):
+            key = _embedding_key(s, embedder.name)
+            stored = v.astype(EMBEDDINGS_CACHE_DTYPE)
+            # Se usa el vector redondeado igual que se guarda: la primera ejecución y las
+            # siguientes (desde la caché) segmentan exactamente igual
+            fresh[key] = stored
+            to_store[key] = stored.tobytes()
+        cache.set_many(to_store)
+
+    rows = [
+        fresh[k] if k in fresh else np.frombuffer(found[k], dtype=EMBEDDINGS_CACHE_DTYPE)
+        for k in keys
+    ]
+    return _normalize_rows(np.vstack(rows).astype(np.float32, copy=False))
+
+
+def _iter_sentences(text: str) -> Iterator[str]:
+    """Separación sencilla por oraciones, perezosa (no materializa la lista completa)."""
+    text = text.strip()
+    pos = 0
+    for m in _SENTENCE_RE.finditer(text):
+        yield text[pos:m.start()]
+        pos = m.end()
+    if pos < len(text):
+        yield text[pos:]
+
+
+def _iter_windows(sentences: Iterable[str], size: int) -> Iterator[List[str]]:
+    window: List[str] = []
+    for s in sentences:
+        window.append(s)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _split_text_semantically(text: str, client: OpenAI, limiter: Optional[RateLimiter] = None) -> List[str]:
+    """
+    Divide un texto largo en chunks semánticos (por tema), respetando
+    un máximo de tokens por chunk y un mínimo para cerrarlo.
+    """
+    return list(_iter_semantic_chunks(text, make_embedder(client, limiter)))
+
+
+def _iter_semantic_chunks(text: str, embedder: Embedder) -> Iterator[str]:
+    """
+    Versión en streaming de `_split_text_semantically`: recorre el texto en ventanas de
+    SEMANTIC_WINDOW_SENTENCES oraciones, así que memoria y tamaño de petición quedan
+    acotados sea cual sea la longitud, y no se descarta ninguna oración.
+    En cada ventana se calcula la segmentación óptima (`_segment_starts`) sobre la serie
+    de similitudes; el último trozo queda abierto y se vuelve a segmentar junto con la
+    ventana siguiente (con sus embeddings, que sirven de contexto a las fronteras).
+    """
+    if _approx_tokens(text) <= 2 * TOKENS_PER_BLOCK_MAX:
+        yield text
+        return
+
+    carried: List[str] = []
+    carried_embs: Optional[np.ndarray] = None
+
+    for window in _iter_windows(_iter_sentences(text), max(2, SEMANTIC_WINDOW_SENTENCES)):
+        embs = _embed_sentences(embedder, window)
+        if carried:
+            window = carried + window
+            embs = np.vstack([carried_embs, embs])
+        # Tokens aproximados de cada oración con su separador, para que el trozo unido no pase del máximo
+        tokens = np.fromiter(((len(s) + 1) / 4 for s in window), dtype=np.float64, count=len(window))
+        gaps = _gap_similarities(embs, SEMANTIC_TILING_WINDOW)
+        starts = _segment_starts(tokens, gaps, embedder.sim_threshold)
+
+        for a, b in zip(starts, starts[1:]):
+            yield " ".join(window[a:b])
+        carried = window[starts[-1]:]
+        carried_embs = embs[starts[-1]:]
+
+    if carried:
+        yield " ".join(carried)
+    elif carried_embs is None:
+        yield text
+
+
+def apply_semantic_split(items: List[Dict[str, Any]], client: OpenAI,
+                         limiter: Optional[RateLimiter] = None) -> List[Dict[str, Any]]:
     """
     Recorre los items; cuando encuentra un item de texto muy largo,
     lo divide en varios items de texto más cortos y cohesionados por tema.
-    Mantiene el orden y no toca los items de imagen.
+    Mantiene el orden y no toca los items de imagen. Los embeddings se piden por lotes
+    y, si se pasa `limiter`, consumen el mismo presupuesto TPM/RPM que los resúmenes.
     """
     if not SEMANTIC_SPLIT_ENABLED:
         return items
+    return list(iter_semantic_split(items, client, limiter))
+
 
-    out: List[Dict[str, Any]] = []
+def iter_semantic_split(items: Iterable[Dict[str, Any]], client: OpenAI,
+                        limiter: Optional[RateLimiter] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Versión en streaming de `apply_semantic_split`: consume y produce items de uno en uno.
+    """
+    embedder: Optional[Embedder] = None
     for it in items:
-        if it.get("kind") != "text":
-            out.append(it)
+        if not SEMANTIC_SPLIT_ENABLED or it.get("kind") != "text":
+            yield it
             continue
 
         text = it.get("text") or ""
         if _approx_tokens(text) <= 2 * TOKENS_PER_BLOCK_MAX:
-            out.append(it)
+            yield it
             continue
 
-        parts = _split_text_semantically(text, client)
-        for p in parts:
-            out.append({"kind": "text", "text": p, "page": it.get("page", 1)})
-
-    return out
+        if embedder is None:
+            embedder = make_embedder(client, limiter)
+        for p in _iter_semantic_chunks(text, embedder):
+            yield {"kind": "text", "text": p, "page": it.get("page", 1)}
@@ -1,7 +1,8 @@
 import json
 from typing import List
 from config import MODEL_SUMMARY, MODEL_EXAM
-from logic.llm_client import make_client
+from logic.llm_client import make_client, chat_completion
+from logic.analyzer.scheduler import shared_limiter
 from logic.prompts import SUMMARY_SYSTEM_PROMPT, exam_system_prompt
 
 
@@ -13,6 +14,8 @@ class ExamGenerator:
         # Modelos definidos en config (mismo valor que antes)
         self.model_summary = MODEL_SUMMARY
         self.model_exam = MODEL_EXAM
+        # Mismo presupuesto TPM/RPM que el análisis de documentos
+        self.limiter = shared_limiter()
 
     @staticmethod
     def _split_summary_text(summary_text: str, max_chars_per_chunk: int = 70000) -> List[str]:
@@ -70,12 +73,16 @@ class ExamGenerator:
             return []
 
         system_prompt = exam_system_prompt(num_questions_part)
+        user_message = f"Contexto de Resumen (Parte):\n{summary_part_context}\n\nGenera exactamente {num_questions_part} preguntas."
+        # Entrada (~4 caracteres por token) más ~200 tokens de salida por pregunta
+        est_tokens = (len(system_prompt) + len(user_message)) // 4 + 200 * num_questions_part
 
-        response = self.client.chat.completions.create(
+        response = chat_completion(
+            self.client, self.limiter, est_tokens,
             model=self.model_exam,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Contexto de Resumen (Parte):\n{summary_part_context}\n\nGenera exactamente {num_questions_part} preguntas."}
+                {"role": "user", "content": user_message}
             ],
             temperature=temperature,
             top_p=top_p,
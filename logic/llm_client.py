@@ -1,6 +1,214 @@
-# logic/llm_client.py
-from openai import OpenAI
+from __future__ import annotations
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+from openai import (
+    OpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError, APIStatusError
+)
+
+from config import (
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_S, RETRY_MAX_DELAY_S,
+    LLM_CACHE_MODE, LLM_CACHE_MAX_MB, LLM_CACHE_TTL_DAYS
+)
+from logic.analyzer.scheduler import RateLimiter, CircuitBreaker, shared_breaker
+from logic.analyzer.cache import DiskCache, get_cache
+
 
 def make_client(api_key: str) -> OpenAI:
-    """Factory mínima para crear el cliente de OpenAI."""
-    return OpenAI(api_key=api_key)
+    """Factory mínima para crear el cliente de OpenAI (los reintentos los gestiona `_call`)."""
+    return OpenAI(api_key=api_key, max_retries=0)
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Convierte '20ms', '1.5s', '6m0s' (formato de x-ratelimit-reset-*) o '3' a segundos."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+
+def _retry_after(headers: Any) -> Optional[float]:
+    """Espera indicada por el servidor: Retry-After(-ms) o, si se agotó, el reset de x-ratelimit."""
+    if headers is None:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+    after = _parse_duration(headers.get("retry-after"))
+    if after is not None:
+        return after
+    waits = []
+    for kind in ("tokens", "requests"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = _parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if reset is not None:
+                waits.append(reset)
+    return max(waits) if waits else None
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, RateLimitError):
+        # Cuota agotada: reintentar no sirve
+        return getattr(e, "code", None) != "insufficient_quota"
+    return isinstance(e, (InternalServerError, APIConnectionError, APITimeoutError))
+
+
+def _call(endpoint: Any, limiter: Optional[RateLimiter], est_tokens: int,
+          breaker: Optional[CircuitBreaker] = None, **kwargs: Any):
+    """
+    Capa resiliente común a todas las llamadas a la API:
+      - reserva presupuesto en el limitador y lo ajusta con el uso real y las cabeceras x-ratelimit-*;
+      - ante 429/5xx/errores de conexión reintenta con backoff exponencial con jitter,
+        respetando Retry-After y pausando el limitador para no provocar el siguiente 429;
+      - un cortocircuito compartido hace fallar rápido si el servicio está caído.
+    """
+    breaker = breaker or shared_breaker()
+    attempt = 0
+    while True:
+        # Solo las llamadas nuevas fallan rápido con el circuito abierto; un reintento
+        # espera a poder probar (una caída breve no debe abortar el lote)
+        probe = breaker.before_call(wait=attempt > 0)
+        charged = limiter.allow(est_tokens) if limiter is not None else 0
+        try:
+            raw = endpoint.with_raw_response.create(**kwargs)
+        except Exception as e:
+            final = not _is_retryable(e) or attempt + 1 >= RETRY_MAX_ATTEMPTS
+            if isinstance(e, (InternalServerError, APIConnectionError, APITimeoutError)):
+                # Cuenta una vez por llamada (al agotar los reintentos) o si falla la prueba
+                if final or probe:
+                    breaker.record_failure()
+                # La llamada no consumió presupuesto: se devuelve para no penalizar el reintento
+                if limiter is not None:
+                    limiter.refund(charged)
+            elif probe:
+                breaker.release()
+            if final:
+                raise
+            response = getattr(e, "response", None) if isinstance(e, APIStatusError) else None
+            headers = getattr(response, "headers", None)
+            delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * (2 ** attempt)))
+            server_wait = _retry_after(headers)
+            if server_wait is not None:
+                delay = server_wait + random.uniform(0, RETRY_BASE_DELAY_S)
+            if limiter is not None:
+                if headers is not None:
+                    limiter.observe_headers(headers)
+                if isinstance(e, RateLimitError):
+                    limiter.pause(delay)
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        resp = raw.parse()
+        if limiter is not None:
+            limiter.observe_headers(raw.headers)
+            limiter.reconcile(est_tokens, charged, getattr(resp, "usage", None))
+        return resp
+
+
+def chat_completion(client: OpenAI, limiter: Optional[RateLimiter] = None, est_tokens: int = 0, **kwargs: Any):
+    """
+    Llama a chat.completions.create pasando antes por el limitador (si se indica),
+    con reintentos, y ajustándolo después con el uso real de la respuesta.
+    """
+    return _call(client.chat.completions, limiter, est_tokens, **kwargs)
+
+
+def create_embeddings(client: OpenAI, limiter: Optional[RateLimiter] = None, est_tokens: int = 0, **kwargs: Any):
+    """Igual que `chat_completion`, para embeddings.create."""
+    return _call(client.embeddings, limiter, est_tokens, **kwargs)
+
+
+# ---------- Caché de respuestas ----------
+
+CACHE_USE = "use"
+CACHE_REFRESH = "refresh"
+CACHE_OFF = "off"
+
+_saved_tokens = 0
+_saved_lock = threading.Lock()
+
+
+def response_cache() -> DiskCache:
+    """Caché en disco de respuestas de chat (LRU por tamaño + caducidad LLM_CACHE_TTL_DAYS)."""
+    return get_cache("llm_responses", LLM_CACHE_MAX_MB, ttl_s=LLM_CACHE_TTL_DAYS * 86400)
+
+
+def response_cache_key(model: str, messages: List[Dict[str, Any]], temperature: Optional[float]) -> str:
+    """Clave: modelo + hash del prompt de sistema + hash del contenido (texto e imágenes)."""
+    system = "".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+    rest = [m for m in messages if m.get("role") != "system"]
+    content = json.dumps([rest, temperature], ensure_ascii=False, sort_keys=True)
+    sys_hash = hashlib.sha256(system.encode("utf-8")).hexdigest()[:16]
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return f"{model}:{sys_hash}:{content_hash}"
+
+
+def response_cache_stats() -> Dict[str, Any]:
+    """Métricas de la caché más los tokens que se han ahorrado por aciertos en este proceso."""
+    stats = response_cache().stats()
+    stats["tokens_saved"] = _saved_tokens
+    return stats
+
+
+def cached_chat_text(client: OpenAI, limiter: Optional[RateLimiter] = None, est_tokens: int = 0,
+                     cache_mode: str = LLM_CACHE_MODE, **kwargs: Any) -> str:
+    """
+    Como `chat_completion`, pero devuelve solo el texto y consulta antes la caché de respuestas.
+    Un acierto no consume presupuesto del limitador. `cache_mode`:
+      - "use": lee y escribe;
+      - "refresh": no lee, pero sobrescribe (invalida lo tocado en esta ejecución);
+      - "off": ni lee ni escribe.
+    Junto a cada respuesta se guarda el uso real (tokens) de la llamada que la produjo.
+    """
+    global _saved_tokens
+    key = None
+    if cache_mode in (CACHE_USE, CACHE_REFRESH):
+        key = response_cache_key(kwargs.get("model", ""), kwargs.get("messages", []), kwargs.get("temperature"))
+        if cache_mode == CACHE_USE:
+            raw = response_cache().get(key)
+            if raw is not None:
+                try:
+                    entry = json.loads(raw.decode("utf-8"))
+                    with _saved_lock:
+                        _saved_tokens += int((entry.get("usage") or {}).get("total_tokens") or 0)
+                    return entry["text"]
+                except (ValueError, KeyError):
+                    response_cache().delete(key)
+
+    resp = chat_completion(client, limiter, est_tokens, **kwargs)
+    text = (resp.choices[0].message.content or "").strip()
+
+    # Solo se guardan respuestas completas (no truncadas por max_tokens)
+    if key is not None and text and getattr(resp.choices[0], "finish_reason", "stop") != "length":
+        usage = getattr(resp, "usage", None)
+        entry = {
+            "model": kwargs.get("model", ""),
+            "text": text,
+            "usage": {
+                "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                "completion_tokens": getattr(usage, "completion_tokens", None),
+                "total_tokens": getattr(usage, "total_tokens", None),
+            },
+            "created": time.time(),
+        }
+        response_cache().set(key, json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+    return text
@@ -0,0 +1,71 @@
+# logic/repositories/checkpoints.py
+import os
+import json
+import time
+import threading
+from typing import Dict
+from utils.paths import CHECKPOINTS_DIR
+
+# Varios bloques del mismo documento terminan en hilos distintos
+_lock = threading.Lock()
+
+
+def _path(doc_hash: str) -> str:
+    return os.path.join(CHECKPOINTS_DIR, f"{doc_hash}.jsonl")
+
+
+def load(doc_hash: str) -> Dict[str, str]:
+    """Devuelve {huella_de_bloque: resumen} ya guardados para el documento (vacío si no hay)."""
+    done: Dict[str, str] = {}
+    try:
+        with open(_path(doc_hash), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    # última línea a medias tras un cierre abrupto
+                    continue
+                if isinstance(rec, dict) and rec.get("fp") and rec.get("summary"):
+                    done[rec["fp"]] = rec["summary"]
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def record(doc_hash: str, fingerprint: str, summary: str) -> bool:
+    """Añade el resumen de un bloque al checkpoint del documento en cuanto llega."""
+    try:
+        with _lock:
+            os.makedirs(CHECKPOINTS_DIR, exist_ok=True)
+            with open(_path(doc_hash), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"fp": fingerprint, "summary": summary}, ensure_ascii=False) + "\n")
+        return True
+    except Exception:
+        return False
+
+
+def discard(doc_hash: str) -> bool:
+    """Elimina el checkpoint (p.ej. cuando el resultado ya se guardó en la biblioteca)."""
+    try:
+        with _lock:
+            os.remove(_path(doc_hash))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def prune(max_age_days: float) -> int:
+    """Borra checkpoints abandonados sin actividad en `max_age_days` días. Devuelve cuántos."""
+    if not os.path.isdir(CHECKPOINTS_DIR):
+        return 0
+    limit = time.time() - max_age_days * 86400
+    removed = 0
+    for filename in os.listdir(CHECKPOINTS_DIR):
+        path = os.path.join(CHECKPOINTS_DIR, filename)
+        try:
+            if filename.endswith(".jsonl") and os.path.getmtime(path) < limit:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
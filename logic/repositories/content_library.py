@@ -2,7 +2,7 @@
 import os
 import json
 import time
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from utils.paths import CONTENT_LIBRARY_DIR
 
 
@@ -32,8 +32,11 @@ def list_items() -> List[Dict[str, Any]]:
     return items
 
 
-def save_item(name: str, source_files: list, summary: str) -> str:
-    """Guarda un item en la biblioteca y devuelve la ruta del archivo generado."""
+def save_item(name: str, source_files: list, summary: str, analysis: Optional[Dict[str, Any]] = None) -> str:
+    """Guarda un item en la biblioteca y devuelve la ruta del archivo generado.
+    `analysis` (opcional) conserva el hash del documento y la lista de bloques
+    [{"fp": huella, "summary": resumen}] para poder re-analizarlo de forma incremental.
+    """
     os.makedirs(CONTENT_LIBRARY_DIR, exist_ok=True)
     content_data = {
         "name": name,
@@ -41,6 +44,14 @@ def save_item(name: str, source_files: list, summary: str) -> str:
         "created_at": time.time(),
         "summary": summary,
     }
+    if analysis:
+        content_data["analysis"] = {
+            "doc_hash": analysis.get("doc_hash", ""),
+            "blocks": [
+                {"fp": b["fp"], "summary": b["summary"]}
+                for b in analysis.get("blocks", []) if b.get("fp") and b.get("summary")
+            ],
+        }
     filename = _safe_filename(name)
     path = os.path.join(CONTENT_LIBRARY_DIR, filename)
     with open(path, "w", encoding="utf-8") as f:
@@ -48,6 +59,22 @@ def save_item(name: str, source_files: list, summary: str) -> str:
     return path
 
 
+def known_block_summaries(source_file: str) -> Dict[str, str]:
+    """Devuelve {huella_de_bloque: resumen} de los items guardados a partir de `source_file`
+    (por nombre de archivo). Si hay varios, los más recientes prevalecen.
+    """
+    found: Dict[str, str] = {}
+    matching = [
+        it for it in list_items()
+        if source_file in (it.get("source_files") or []) and isinstance(it.get("analysis"), dict)
+    ]
+    for it in sorted(matching, key=lambda it: it.get("created_at", 0)):
+        for b in it["analysis"].get("blocks", []):
+            if isinstance(b, dict) and b.get("fp") and b.get("summary"):
+                found[b["fp"]] = b["summary"]
+    return found
+
+
 def delete_item_by_path(file_path: str) -> bool:
     """Elimina el archivo indicado. Devuelve True si lo elimina, False si no existía."""
     try:
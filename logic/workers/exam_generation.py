@@ -1,5 +1,4 @@
 # logic/workers/exam_generation.py
-import time
 import traceback
 from PyQt6.QtCore import QThread, pyqtSignal
 
@@ -48,8 +47,6 @@ class ExamGenerationWorker(QThread):
                         self.top_p
                     )
                     all_questions.extend(part_questions)
-                    if i < len(summary_chunks) - 1:
-                        time.sleep(1)
             else:
                 self.progress.emit("Generando preguntas del resumen completo...")
                 all_questions = generator.generate_exam_from_summary_part(
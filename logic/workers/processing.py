@@ -1,109 +1,260 @@
 # logic/workers/processing.py
 from __future__ import annotations
 import os
-import time
+import threading
 import traceback
-from typing import List
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed
+from itertools import chain
+from typing import List, Dict, Any, Deque, Iterator
 
 from PyQt6.QtCore import QThread, pyqtSignal
-from openai import APIConnectionError, RateLimitError, AuthenticationError, BadRequestError, InternalServerError
-
-from config import MODEL_VISION
-from logic.llm_client import make_client
-from logic.analyzer.ingest import ingest_files
-from logic.analyzer.semantic import apply_semantic_split
-from logic.analyzer.ocr import apply_ocr_to_items
-from logic.analyzer.segment import segment_items_to_blocks, block_to_chat_content, block_cost_tokens
+from openai import OpenAI, APIConnectionError, RateLimitError, AuthenticationError, BadRequestError, InternalServerError
+
+from config import (
+    MODEL_VISION, PERCEPTUAL_DEDUP, PERCEPTUAL_PERSIST, FILE_CONCURRENCY, CONCURRENCY,
+    CHECKPOINTS_ENABLED, CHECKPOINT_MAX_AGE_DAYS, LLM_CACHE_MODE, AGGREGATE_OUTPUT_TOKENS
+)
+from utils.paths import PERCEPTUAL_INDEX_FILE
+from logic.llm_client import make_client, response_cache, CACHE_USE, CACHE_OFF
+from logic.analyzer.ingest import iter_items, file_digest
+from logic.analyzer.images import PerceptualIndex, iter_drop_near_duplicates, prescan
+from logic.analyzer.semantic import iter_semantic_split
+from logic.analyzer.ocr import iter_ocr_items
+from logic.analyzer.segment import iter_blocks, block_to_chat_content, block_cost_tokens, block_fingerprint
 from logic.analyzer.llm_summarizers import summarize_block, aggregate_summaries
-from logic.analyzer.scheduler import RateLimiter
+from logic.analyzer.scheduler import RateLimiter, CircuitOpenError, shared_limiter
+from logic.analyzer.aggregator import TreeReducer
 from logic.analyzer.assembler import assemble_final_summary
+from logic.repositories import checkpoints
+from logic.repositories import content_library
 
 
 class ProcessingWorker(QThread):
     """
     Analiza documentos de forma multimodal (texto + imágenes) con segmentación semántica
-    y OCR opcional, respetando TPM/RPM. Emite (summary, filename) por cada archivo.
+    y OCR opcional, respetando TPM/RPM. Procesa hasta FILE_CONCURRENCY archivos a la vez
+    y emite (summary, filename, meta) por cada archivo en cuanto termina; `meta` lleva
+    el hash del documento y la huella+resumen de cada bloque.
+    Cada resumen de bloque se guarda en un checkpoint del documento, así que relanzar
+    el mismo archivo tras un fallo retoma desde los bloques que faltan. Igualmente, al
+    re-analizar un archivo ya guardado en la biblioteca solo se resumen los bloques
+    cuyo contenido cambió.
+    `cache_mode` controla la caché de respuestas del LLM en esta ejecución
+    ("use", "refresh" para invalidarla, "off" para ignorarla); fuera de "use" tampoco
+    se reutilizan bloques de la biblioteca ni checkpoints.
     """
-    finished = pyqtSignal(str, str)   # summary, filename
+    finished = pyqtSignal(str, str, dict)   # summary, filename, meta ({"doc_hash", "blocks"})
     all_done = pyqtSignal()
-    error = pyqtSignal(str)
+    error = pyqtSignal(str)        # error fatal: la ejecución termina
+    file_error = pyqtSignal(str)   # fallo de un archivo: los demás siguen
     progress = pyqtSignal(str)
 
-    def __init__(self, api_key: str, file_paths: List[str]):
+    def __init__(self, api_key: str, file_paths: List[str], cache_mode: str = LLM_CACHE_MODE):
         super().__init__()
         self.api_key = api_key
         self.file_paths = file_paths
+        self.cache_mode = cache_mode
+        self._abort = threading.Event()
 
     def run(self):
         try:
             client = make_client(self.api_key)
-            limiter = RateLimiter()
-
-            for file_path in self.file_paths:
-                filename = os.path.basename(file_path)
-                self.progress.emit(f"Preparando '{filename}'…")
-
-                # 1) Ingesta (texto + imágenes, sin OCR)
-                items = ingest_files([file_path])
-                if not items:
-                    self.error.emit(f"No se pudo extraer contenido de {filename}.")
-                    continue
-
-                # 2) Segmentación semántica previa (solo divide textos largos)
-                items = apply_semantic_split(items, client)
-
-                # 3) OCR opcional (local o LLM) sobre imágenes
-                #    El limitador se usa solo si se dispara OCR via LLM
-                apply_ocr_to_items(items, client, allow_fn=limiter.allow)
-
-                # 4) Empaquetado a bloques (tokens + límite de imágenes/bloque)
-                blocks = segment_items_to_blocks(items)
-                if not blocks:
-                    self.error.emit(f"El documento {filename} parece estar vacío.")
-                    continue
-
-                block_summaries: List[str] = []
-
-                # 5) Resumen por bloque (multimodal)
-                for i, block in enumerate(blocks, start=1):
-                    self.progress.emit(f"Analizando bloque {i}/{len(blocks)} de {filename}…")
-                    content = block_to_chat_content(block)
-                    est_tokens = block_cost_tokens(block)
-                    limiter.allow(est_tokens)
-
-                    summary = summarize_block(
-                        client=client,
-                        model=MODEL_VISION,
-                        content=content,
-                        temperature=0.2
-                    )
-                    block_summaries.append(summary)
-
-                # 6) Agregación opcional
-                if len(block_summaries) >= 6:
-                    self.progress.emit(f"Compactando resumen de {filename}…")
-                    limiter.allow(1200)  # coste estimado
-                    final_summary = aggregate_summaries(client, MODEL_VISION, block_summaries)
-                else:
-                    final_summary = assemble_final_summary(block_summaries)
-
-                self.progress.emit(f"Análisis completado para {filename}.")
-                self.finished.emit(final_summary, filename)
+            limiter = shared_limiter()
+            doc_hashes = [file_digest(p) for p in self.file_paths]
+            # Índice perceptual compartido por todos los archivos de esta ejecución; cada
+            # archivo solo se deduplica contra los anteriores en la lista
+            phash_index = PerceptualIndex(path=PERCEPTUAL_INDEX_FILE if PERCEPTUAL_PERSIST else None)
+            phash_index.load()
+            phash_keys = phash_index.begin(doc_hashes)
+            if PERCEPTUAL_DEDUP and len(self.file_paths) > 1:
+                # Pasada previa (la ingesta queda en caché para el análisis): cada archivo se
+                # deduplica contra los anteriores de la lista sin esperar a que terminen
+                self.progress.emit("Comparando imágenes entre documentos…")
+                prescan([(key, self._prescan_items(path))
+                         for path, key in zip(self.file_paths[:-1], phash_keys)], phash_index)
+            checkpoints.prune(CHECKPOINT_MAX_AGE_DAYS)
+            if self.cache_mode != CACHE_OFF:
+                response_cache().purge_expired()
 
-                time.sleep(0.5)
+            # Varios archivos en vuelo: mientras uno espera a la API, otro se ingiere.
+            # El presupuesto TPM/RPM es el mismo limitador compartido, y como mucho
+            # CONCURRENCY bloques (de cualquier archivo) se resumen a la vez.
+            block_pool = ThreadPoolExecutor(max_workers=max(1, CONCURRENCY), thread_name_prefix="block")
+            with ThreadPoolExecutor(max_workers=max(1, FILE_CONCURRENCY), thread_name_prefix="file") as pool:
+                futures = {
+                    pool.submit(self._process_file, file_path, doc_hash, phash_key, client, limiter, phash_index, block_pool): file_path
+                    for file_path, doc_hash, phash_key in zip(self.file_paths, doc_hashes, phash_keys)
+                }
+                try:
+                    for fut in as_completed(futures):
+                        try:
+                            fut.result()
+                        except (AuthenticationError, CircuitOpenError):
+                            raise
+                        except CancelledError:
+                            # Archivo detenido por el aborto: no hay nada que informar
+                            continue
+                        except Exception as e:
+                            # Los reintentos se agotaron solo para este archivo: se informa y siguen los demás
+                            filename = os.path.basename(futures[fut])
+                            self.file_error.emit(f"{filename}: {self._describe_error(e)}")
+                except BaseException:
+                    # Un error fatal (autenticación, API caída) detiene el resto de archivos
+                    self._abort.set()
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+                finally:
+                    block_pool.shutdown(wait=False)
 
+            phash_index.save()
             self.all_done.emit()
 
-        except AuthenticationError as e:
-            self.error.emit(f"Error de Autenticación: {e}")
-        except RateLimitError as e:
-            self.error.emit(f"Error de Límite de Tasa: {e}")
-        except APIConnectionError as e:
-            self.error.emit(f"Error de Conexión: {e}")
-        except BadRequestError as e:
-            self.error.emit(f"Error de Solicitud: {e}")
-        except InternalServerError as e:
-            self.error.emit(f"Error Interno del Servidor: {e}")
         except Exception as e:
-            print(f"ERROR INESPERADO EN PROCESSING WORKER:\n{traceback.format_exc()}")
-            self.error.emit(f"Error inesperado: {str(e)}")
+            self.error.emit(self._describe_error(e))
+
+    @staticmethod
+    def _prescan_items(file_path: str) -> Iterator[Dict[str, Any]]:
+        # Un archivo ilegible se omite aquí; el error se informa al analizarlo
+        try:
+            yield from iter_items([file_path])
+        except Exception:
+            return
+
+    @staticmethod
+    def _describe_error(e: Exception) -> str:
+        if isinstance(e, AuthenticationError):
+            return f"Error de Autenticación: {e}"
+        if isinstance(e, RateLimitError):
+            return f"Error de Límite de Tasa: {e}"
+        if isinstance(e, APIConnectionError):
+            return f"Error de Conexión: {e}"
+        if isinstance(e, BadRequestError):
+            return f"Error de Solicitud: {e}"
+        if isinstance(e, InternalServerError):
+            return f"Error Interno del Servidor: {e}"
+        if isinstance(e, CircuitOpenError):
+            return f"Servicio no disponible: {e}"
+        print(f"ERROR INESPERADO EN PROCESSING WORKER:\n{traceback.format_exc()}")
+        return f"Error inesperado: {str(e)}"
+
+    def _process_file(self, file_path: str, doc_hash: str, phash_key: str, client: OpenAI, limiter: RateLimiter,
+                      phash_index: PerceptualIndex, block_pool: ThreadPoolExecutor) -> None:
+        filename = os.path.basename(file_path)
+        self.progress.emit(f"Preparando '{filename}'…")
+
+        # Resúmenes reutilizables: versiones anteriores guardadas en la biblioteca
+        # (re-análisis incremental) y el checkpoint de una ejecución interrumpida.
+        # Fuera del modo "use" se pide todo de nuevo, igual que con la caché de respuestas.
+        done: Dict[str, str] = {}
+        if self.cache_mode == CACHE_USE:
+            done = content_library.known_block_summaries(filename)
+        if CHECKPOINTS_ENABLED and self.cache_mode == CACHE_USE:
+            resumed = checkpoints.load(doc_hash)
+            if resumed:
+                self.progress.emit(f"Reanudando '{filename}': {len(resumed)} bloques ya analizados…")
+            done.update(resumed)
+
+        # 1) Ingesta (texto + imágenes, sin OCR), en streaming
+        items = iter_items([file_path])
+        first = next(items, None)
+        if first is None:
+            self.file_error.emit(f"No se pudo extraer contenido de {filename}.")
+            return
+        items = chain([first], items)
+        if PERCEPTUAL_DEDUP:
+            items = iter_drop_near_duplicates(items, phash_index, phash_key)
+
+        # 2) Segmentación semántica previa (solo divide textos largos)
+        items = iter_semantic_split(items, client, limiter)
+
+        # 3) OCR opcional (local o LLM) sobre imágenes
+        #    El limitador se usa solo si se dispara OCR via LLM
+        items = iter_ocr_items(items, client, limiter, self.cache_mode)
+
+        # 4) Empaquetado a bloques (tokens + límite de imágenes/bloque) y
+        # 5) resumen por bloque (multimodal). Cada bloque se envía al pool en cuanto se
+        #    cierra; los resultados se recogen en orden y solo 2*CONCURRENCY bloques
+        #    quedan pendientes, para no adelantar la ingesta sin límite.
+        #    Los bloques presentes en el checkpoint no se vuelven a pedir.
+        #    Cada resumen recibido entra ya en el árbol de agregación (paso 6).
+        reducer = TreeReducer(
+            lambda texts: self._aggregate(client, limiter, texts, filename), block_pool
+        )
+        block_summaries: List[str] = []
+        fingerprints: List[str] = []
+        reused = 0
+        in_flight: Deque[Future] = deque()
+        try:
+            for i, block in enumerate(iter_blocks(items), start=1):
+                if self._abort.is_set():
+                    return
+                fp = block_fingerprint(block)
+                fingerprints.append(fp)
+                if fp in done:
+                    reused += 1
+                    fut: Future = Future()
+                    fut.set_result(done[fp])
+                    in_flight.append(fut)
+                else:
+                    in_flight.append(block_pool.submit(self._summarize_block, client, limiter, block, i, filename, doc_hash, fp))
+                while len(in_flight) > 2 * max(1, CONCURRENCY):
+                    block_summaries.append(in_flight.popleft().result())
+                    reducer.add(block_summaries[-1])
+            while in_flight:
+                block_summaries.append(in_flight.popleft().result())
+                reducer.add(block_summaries[-1])
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+
+        if not block_summaries:
+            self.file_error.emit(f"El documento {filename} parece estar vacío.")
+            return
+        if reused:
+            self.progress.emit(f"{filename}: {reused} de {len(block_summaries)} bloques sin cambios reutilizados.")
+
+        # 6) Agregación opcional: fusiones por grupos acotados en tokens, en paralelo por
+        #    nivel, hasta un único resumen (un documento mediano cabe en una sola fusión)
+        if len(block_summaries) >= 6:
+            self.progress.emit(f"Compactando resumen de {filename}…")
+            final_summary = reducer.result()
+        else:
+            final_summary = assemble_final_summary(block_summaries)
+
+        # Tras un aborto el resumen estaría incompleto: no se ofrece para guardar
+        if self._abort.is_set():
+            return
+        self.progress.emit(f"Análisis completado para {filename}.")
+        blocks = [{"fp": fp, "summary": s} for fp, s in zip(fingerprints, block_summaries)]
+        self.finished.emit(final_summary, filename, {"doc_hash": doc_hash, "blocks": blocks})
+
+    def _aggregate(self, client: OpenAI, limiter: RateLimiter, texts: List[str], filename: str) -> str:
+        if self._abort.is_set():
+            raise CancelledError()
+        self.progress.emit(f"Fusionando {len(texts)} resúmenes parciales de {filename}…")
+        est_tokens = sum(len(t) for t in texts) // 4 + AGGREGATE_OUTPUT_TOKENS  # entrada + salida estimada
+        return aggregate_summaries(client, MODEL_VISION, texts, limiter=limiter,
+                                   est_tokens=est_tokens, cache_mode=self.cache_mode)
+
+    def _summarize_block(self, client: OpenAI, limiter: RateLimiter, block: List[Dict[str, Any]], i: int,
+                         filename: str, doc_hash: str, fp: str) -> str:
+        if self._abort.is_set():
+            raise CancelledError()
+        self.progress.emit(f"Analizando bloque {i} de {filename} (pág. {block[0].get('page', 1)})…")
+        content = block_to_chat_content(block)
+        est_tokens = block_cost_tokens(block)
+
+        summary = summarize_block(
+            client=client,
+            model=MODEL_VISION,
+            content=content,
+            temperature=0.2,
+            limiter=limiter,
+            est_tokens=est_tokens,
+            cache_mode=self.cache_mode
+        )
+        if CHECKPOINTS_ENABLED:
+            checkpoints.record(doc_hash, fp, summary)
+        return summary
@@ -16,8 +16,10 @@ from ui.panels.analysis_panel import AnalysisPanel
 from ui.panels.generation_panel import GenerationPanel
 
 from logic.workers.processing import ProcessingWorker
+from logic.llm_client import CACHE_REFRESH
 from logic.workers.exam_generation import ExamGenerationWorker
 from logic.repositories import content_library as content_repo
+from logic.repositories import checkpoints as checkpoints_repo
 from utils.paths import ensure_dirs
 
 
@@ -137,16 +139,20 @@ class MainWindow(QMainWindow):
         self.show_loader("Analizando documentos…")
         self._set_panels_enabled(False)
 
-        self.processing_worker = ProcessingWorker(api_key, file_paths)
+        if self.analysis_panel.bypass_cache():
+            self.processing_worker = ProcessingWorker(api_key, file_paths, cache_mode=CACHE_REFRESH)
+        else:
+            self.processing_worker = ProcessingWorker(api_key, file_paths)
         self.processing_worker.progress.connect(self._update_status)
         self.processing_worker.error.connect(self._on_task_error)
+        self.processing_worker.file_error.connect(self._on_file_error)
         self.processing_worker.finished.connect(self._on_processing_finished)
         self.processing_worker.all_done.connect(self._on_processing_all_done)
         self.processing_worker.start()
 
-    def _on_processing_finished(self, summary, filename):
+    def _on_processing_finished(self, summary, filename, meta):
         self.analysis_panel.mark_processed(filename)
-        self.pending_saves.append((summary, filename))
+        self.pending_saves.append((summary, filename, meta))
         if not self.naming_dialog_active:
             self._process_next_save()
 
@@ -166,7 +172,7 @@ class MainWindow(QMainWindow):
         self.hide_loader()
         self._set_panels_enabled(True)
 
-        summary, filename = self.pending_saves.pop(0)
+        summary, filename, meta = self.pending_saves.pop(0)
         suggested = os.path.splitext(filename)[0]
 
         from PyQt6.QtWidgets import QInputDialog
@@ -179,7 +185,9 @@ class MainWindow(QMainWindow):
 
         if ok and name:
             try:
-                content_repo.save_item(name=name, source_files=[filename], summary=summary)
+                content_repo.save_item(name=name, source_files=[filename], summary=summary, analysis=meta)
+                # Ya está en la biblioteca: el checkpoint de reanudación sobra
+                checkpoints_repo.discard(meta.get("doc_hash", ""))
                 self.load_content_library()
                 self.statusBar().showMessage(f"Contenido '{name}' guardado en la biblioteca.")
             except Exception as e:
@@ -270,6 +278,10 @@ class MainWindow(QMainWindow):
         self._set_panels_enabled(True)
         QMessageBox.critical(self, "Error", message)
 
+    def _on_file_error(self, message: str):
+        # El resto de documentos sigue en curso: no se tocan el loader ni los paneles
+        QMessageBox.warning(self, "Error en un documento", message)
+
     def _set_panels_enabled(self, enabled: bool):
         self.analysis_panel.setEnabled(enabled)
         self.generation_panel.setEnabled(enabled)
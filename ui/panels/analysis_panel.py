@@ -2,7 +2,7 @@ import os
 from typing import List
 from PyQt6.QtWidgets import (
     QWidget, QVBoxLayout, QGroupBox, QListWidget, QPushButton, QHBoxLayout,
-    QFileDialog
+    QFileDialog, QCheckBox
 )
 from PyQt6.QtCore import pyqtSignal
 
@@ -30,6 +30,13 @@ class AnalysisPanel(QWidget):
         btns.addWidget(clear_files_btn)
         layout.addLayout(btns)
 
+        self.no_cache_check = QCheckBox("Re-analizar sin caché")
+        self.no_cache_check.setToolTip(
+            "Vuelve a pedir todos los resúmenes al modelo, sin reutilizar respuestas guardadas "
+            "ni bloques de análisis anteriores (las nuevas respuestas sí se guardan)."
+        )
+        layout.addWidget(self.no_cache_check)
+
         self.process_btn = QPushButton("Analizar y Guardar en Biblioteca")
         self.process_btn.setEnabled(False)
         self.process_btn.clicked.connect(lambda: self.request_process.emit())
@@ -54,6 +61,9 @@ class AnalysisPanel(QWidget):
     def get_file_paths(self) -> List[str]:
         return list(self._file_paths)
 
+    def bypass_cache(self) -> bool:
+        return self.no_cache_check.isChecked()
+
     def mark_processed(self, filename: str):
         base = os.path.basename(filename)
         for i in range(self.file_list_widget.count()):
@@ -9,6 +9,9 @@ FONTS_DIR = os.path.join(ASSETS_DIR, "fonts")
 
 CONTENT_LIBRARY_DIR = os.path.join(PROJECT_ROOT, "content_library")
 EXAMS_DIR = os.path.join(PROJECT_ROOT, "exams")
+CACHE_DIR = os.path.join(PROJECT_ROOT, "cache")
+PERCEPTUAL_INDEX_FILE = os.path.join(CACHE_DIR, "perceptual_index.json")
+CHECKPOINTS_DIR = os.path.join(CACHE_DIR, "checkpoints")
 
 QUESTION_BANK_FILE = os.path.join(PROJECT_ROOT, "question_bank.json")
 REPORTED_QUESTIONS_FILE = os.path.join(PROJECT_ROOT, "reported_questions.jsonl")